@@ -0,0 +1,287 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+
+from __future__ import print_function
+import multiprocessing
+import os
+import numpy as np
+import scipy.sparse
+
+
+def getMeanStd(data, columns=None, chunkSize=65536):
+    '''
+    Returns the column wise mean and (population) standard deviation of the
+    2D array data in a single pass over chunks of chunkSize rows. data can be
+    a memory mapped array, only one chunk is loaded in memory at a time.
+
+    The statistics of the chunks are merged with the parallel algorithm of
+    Chan et al., in float64.
+    Refer: https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance
+
+    columns: Optional slice of columns to compute the statistics for.
+    returns mean, std
+    '''
+    assert data.ndim == 2
+    if columns is None:
+        columns = slice(None)
+    count = 0
+    mean = None
+    M2 = None
+    for start in range(0, data.shape[0], chunkSize):
+        chunk = np.asarray(data[start:start + chunkSize, columns],
+                           dtype=np.float64)
+        chunkCount = chunk.shape[0]
+        chunkMean = np.mean(chunk, axis=0)
+        chunkM2 = np.sum(np.square(chunk - chunkMean), axis=0)
+        if mean is None:
+            count, mean, M2 = chunkCount, chunkMean, chunkM2
+            continue
+        delta = chunkMean - mean
+        total = count + chunkCount
+        mean = mean + delta * (float(chunkCount) / total)
+        M2 = M2 + chunkM2 + np.square(delta) * (float(count) * chunkCount /
+                                                total)
+        count = total
+    assert count > 0, 'Statistics of an empty array are undefined'
+    return mean, np.sqrt(M2 / count)
+
+
+class NpyDataset:
+    '''
+    Memory mapped view of a .npy file of form [lbl feats] for each data point
+    (the format used by the example scripts).
+
+    The file is never loaded as a whole. Rows are read from the memory map
+    only when indexed and are returned as mean-var normalised float32 arrays,
+    optionally with a bias column of ones appended. The object has shape and
+    ndim attributes and supports X[rows] and X[rows, cols] indexing, so it can
+    be passed to the trainers in place of a numpy feature matrix. np.asarray
+    materialises the complete (normalised) feature matrix.
+
+    fileName: Path of the .npy file.
+    mean, std: Normalisation statistics of the features. If not provided,
+        they are computed from this file in one streaming pass (see
+        getMeanStd). Use the statistics of the training set for the test set.
+    addBias: Append a column of ones to the features.
+    chunkSize: Number of rows per chunk for the statistics pass.
+    '''
+
+    def __init__(self, fileName, mean=None, std=None, addBias=False,
+                 chunkSize=65536):
+        self.data = np.load(fileName, mmap_mode='r')
+        assert self.data.ndim == 2, 'Expected a 2D [lbl feats] array'
+        self.dataDimension = int(self.data.shape[1]) - 1
+        self.addBias = addBias
+        if mean is None or std is None:
+            mean, std = getMeanStd(self.data, columns=slice(1, None),
+                                   chunkSize=chunkSize)
+            std[std[:] < 0.000001] = 1
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.std = np.asarray(std, dtype=np.float32)
+        numCols = self.dataDimension + int(addBias)
+        self.shape = (int(self.data.shape[0]), numCols)
+        self.ndim = 2
+        self.dtype = np.dtype(np.float32)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def getLabels(self):
+        '''
+        Returns the label column as a numpy array
+        '''
+        return np.array(self.data[:, 0])
+
+    def __getRows(self, index):
+        rows = np.asarray(self.data[index], dtype=np.float32)
+        squeeze = (rows.ndim == 1)
+        rows = np.atleast_2d(rows)
+        X = np.empty([rows.shape[0], self.shape[1]], dtype=np.float32)
+        np.subtract(rows[:, 1:], self.mean, out=X[:, :self.dataDimension])
+        X[:, :self.dataDimension] /= self.std
+        if self.addBias:
+            X[:, -1] = 1.0
+        if squeeze:
+            return X[0]
+        return X
+
+    def __getitem__(self, index):
+        if isinstance(index, tuple):
+            X = self.__getRows(index[0])
+            if X.ndim == 1:
+                return X[index[1:]]
+            return X[(slice(None),) + tuple(index[1:])]
+        return self.__getRows(index)
+
+    def __array__(self, dtype=None):
+        X = self[:]
+        if dtype is not None:
+            X = X.astype(dtype)
+        return X
+
+
+def _getChunkBoundaries(fileName, chunkSize):
+    '''
+    Splits the file into byte ranges of about chunkSize bytes. Every range
+    starts at the beginning of a line.
+    '''
+    fileSize = os.path.getsize(fileName)
+    boundaries = [0]
+    with open(fileName, 'rb') as f:
+        for offset in range(chunkSize, fileSize, chunkSize):
+            if offset <= boundaries[-1]:
+                continue
+            f.seek(offset - 1)
+            # Move to the start of the next line
+            f.readline()
+            position = f.tell()
+            if position >= fileSize:
+                break
+            boundaries.append(position)
+    boundaries.append(fileSize)
+    return [(boundaries[i], boundaries[i + 1])
+            for i in range(len(boundaries) - 1)]
+
+
+def _parseSvmlightChunk(args):
+    '''
+    Parses the lines in the byte range [start, end) of an svmlight file.
+
+    returns labels, row indices, feature indices (as in the file) and values
+    of the non-zeros, each as a numpy array
+    '''
+    fileName, start, end = args
+    with open(fileName, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    labels, rows, cols, vals = [], [], [], []
+    for line in data.splitlines():
+        line = line.split(b'#', 1)[0].strip()
+        if len(line) == 0:
+            continue
+        tokens = line.split()
+        row = len(labels)
+        labels.append(float(tokens[0]))
+        for token in tokens[1:]:
+            index, value = token.split(b':')
+            if index == b'qid':
+                continue
+            rows.append(row)
+            cols.append(int(index))
+            vals.append(float(value))
+    return (np.array(labels, dtype=np.float64),
+            np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int64),
+            np.array(vals, dtype=np.float64))
+
+
+def _scanSvmlightChunk(args):
+    '''
+    returns number of rows, min and max feature index in a byte range
+    '''
+    labels, _, cols, _ = _parseSvmlightChunk(args)
+    if len(cols) == 0:
+        return len(labels), None, None
+    return len(labels), int(np.min(cols)), int(np.max(cols))
+
+
+def _writeSvmlightChunk(args):
+    '''
+    Parses a byte range and writes it as [lbl feats] rows, either into the
+    dense .npy memmap at rowOffset or as a CSR shard. Only the non-zeros
+    are scattered into the (zero initialised) memmap, so memory use grows
+    with the non-zeros of the chunk and not with its dense size.
+    '''
+    fileName, start, end, outFile, rowOffset, offset, numFeatures, fmt = args
+    labels, rows, cols, vals = _parseSvmlightChunk((fileName, start, end))
+    cols = cols - offset + 1
+    valid = (cols >= 1) & (cols <= numFeatures)
+    rows, cols, vals = rows[valid], cols[valid], vals[valid]
+    numRows = len(labels)
+    if fmt == 'dense':
+        out = np.load(outFile, mmap_mode='r+')
+        out[rowOffset:rowOffset + numRows, 0] = labels
+        out[rows + rowOffset, cols] = vals
+        out.flush()
+        del out
+        return outFile
+    rows = np.concatenate([np.arange(numRows), rows])
+    cols = np.concatenate([np.zeros(numRows, dtype=np.int64), cols])
+    vals = np.concatenate([labels, vals])
+    shard = scipy.sparse.csr_matrix((vals.astype(np.float32), (rows, cols)),
+                                    shape=[numRows, numFeatures + 1])
+    scipy.sparse.save_npz(outFile, shard)
+    return outFile
+
+
+def convertSvmlight(fileName, outFile, numFeatures=None, zeroBased='auto',
+                    format='dense', chunkSize=64 * 1024 * 1024,
+                    numProcesses=1):
+    '''
+    Converts an svmlight/libsvm file into the [lbl feats] format of the
+    example scripts without loading the whole file in memory.
+
+    The file is split into byte ranges of about chunkSize bytes (aligned to
+    lines). A first pass over the chunks counts the rows and finds the
+    feature index range; a second pass parses each chunk again and writes
+    its non-zeros to disk. Memory use per chunk is proportional to its
+    size in bytes (its non-zeros), independent of numFeatures. With numProcesses > 1, the chunks of each pass are
+    processed by a multiprocessing pool.
+
+    fileName: The svmlight file.
+    outFile: For format='dense', the float32 .npy file to create. For
+        format='csr', the prefix of the shards; shard i is written to
+        outFile + '.%05d.npz' % i (scipy.sparse.save_npz, load with
+        scipy.sparse.load_npz). Shards contain float32 CSR matrices with the
+        label in column 0.
+    numFeatures: Number of features. Inferred from the largest feature
+        index if not provided. Features with larger indices are dropped.
+    zeroBased: Whether feature indices start at 0 or 1. 'auto' decides
+        from the whole file: zero based if any feature index is 0.
+    format: 'dense' or 'csr'.
+
+    returns outFile for format='dense' and the list of shard files for
+    format='csr'
+    '''
+    assert format in ['dense', 'csr'], 'format should be dense or csr'
+    assert zeroBased in ['auto', True, False]
+    chunks = [(fileName, start, end) for start, end in
+              _getChunkBoundaries(fileName, chunkSize)]
+    pool = None
+    mapFunc = map
+    if numProcesses > 1:
+        pool = multiprocessing.Pool(numProcesses)
+        mapFunc = pool.map
+    try:
+        stats = list(mapFunc(_scanSvmlightChunk, chunks))
+        numRowsList = [x[0] for x in stats]
+        minIndexList = [x[1] for x in stats if x[1] is not None]
+        maxIndexList = [x[2] for x in stats if x[2] is not None]
+        minIndex = min(minIndexList) if len(minIndexList) > 0 else 1
+        maxIndex = max(maxIndexList) if len(maxIndexList) > 0 else 0
+        if zeroBased == 'auto':
+            zeroBased = (minIndex == 0)
+        offset = 0 if zeroBased else 1
+        if numFeatures is None:
+            numFeatures = max(maxIndex + 1 - offset, 0)
+        rowOffsets = np.cumsum([0] + numRowsList)
+        if format == 'dense':
+            out = np.lib.format.open_memmap(outFile, mode='w+',
+                                            dtype=np.float32,
+                                            shape=(int(rowOffsets[-1]),
+                                                   numFeatures + 1))
+            del out
+            shardFiles = [outFile] * len(chunks)
+        else:
+            shardFiles = [outFile + '.%05d.npz' % i
+                          for i in range(len(chunks))]
+        args = [(fileName, start, end, shardFiles[i], int(rowOffsets[i]),
+                 offset, numFeatures, format)
+                for i, (_, start, end) in enumerate(chunks)]
+        list(mapFunc(_writeSvmlightChunk, args))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    if format == 'dense':
+        return outFile
+    return shardFiles
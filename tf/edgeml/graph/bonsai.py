@@ -9,7 +9,7 @@ class Bonsai:
 
     def __init__(self, numClasses, dataDimension, projectionDimension,
                  treeDepth, sigma,
-                 W=None, T=None, V=None, Z=None):
+                 W=None, T=None, V=None, Z=None, fusedNodeEval=False):
         '''
         Expected Dimensions:
 
@@ -27,6 +27,10 @@ class Bonsai:
         sigmaI - has to be set to infinity(1e9 for practicality)
         while doing testing/inference
         numClasses will be reset to 1 in binary case
+
+        fusedNodeEval - Evaluates all the nodes with a single matmul each for
+        W, V and T and computes node probabilities level by level, instead of
+        building separate ops for every node. Preferred for deeper trees.
         '''
 
         self.dataDimension = dataDimension
@@ -39,6 +43,7 @@ class Bonsai:
 
         self.treeDepth = treeDepth
         self.sigma = sigma
+        self.fusedNodeEval = fusedNodeEval
 
         self.internalNodes = 2**self.treeDepth - 1
         self.totalNodes = 2 * self.internalNodes + 1
@@ -88,15 +93,33 @@ class Bonsai:
         Expected Dimensions
 
         X is [_, self.dataDimension]
+        X can also be a tf.SparseTensor (for instance a tf.sparse_placeholder)
+        in which case the projection Z.X is a sparse-dense matmul and X is
+        never densified.
         '''
         errmsg = "Dimension Mismatch, X is [_, self.dataDimension]"
-        assert (len(X.shape) == 2 and int(
-            X.shape[1]) == self.dataDimension), errmsg
+        if isinstance(X, tf.SparseTensor):
+            # Dimensions of sparse placeholders are not always known
+            assert X.shape.ndims in [None, 2], errmsg
+            if X.shape.ndims == 2 and X.shape[1].value is not None:
+                assert X.shape[1].value == self.dataDimension, errmsg
+        else:
+            assert (len(X.shape) == 2 and int(
+                X.shape[1]) == self.dataDimension), errmsg
         if self.score is not None:
             return self.score, self.X_
 
-        X_ = tf.divide(tf.matmul(self.Z, X, transpose_b=True),
-                       self.projectionDimension)
+        if isinstance(X, tf.SparseTensor):
+            ZX = tf.transpose(tf.sparse_tensor_dense_matmul(X, self.Z,
+                                                            adjoint_b=True))
+        else:
+            ZX = tf.matmul(self.Z, X, transpose_b=True)
+        X_ = tf.divide(ZX, self.projectionDimension)
+
+        if self.fusedNodeEval is True:
+            self.score = self.__fusedScore(X_, sigmaI)
+            self.X_ = X_
+            return self.score, self.X_
 
         W_ = self.W[0:(self.numClasses)]
         V_ = self.V[0:(self.numClasses)]
@@ -125,6 +148,36 @@ class Bonsai:
         self.X_ = X_
         return self.score, self.X_
 
+    def __fusedScore(self, X_, sigmaI):
+        '''
+        Score of all the nodes with one matmul each against W, V and T.
+        Node probabilities are computed a level at a time using the heap
+        layout of the tree; the children of node i are 2i + 1 (T.X_ > 0)
+        and 2i + 2 (T.X_ < 0).
+        '''
+        numPoints = tf.shape(X_)[1]
+        dims = [self.totalNodes, self.numClasses, -1]
+        WX = tf.reshape(tf.matmul(self.W, X_), dims)
+        VX = tf.reshape(tf.matmul(self.V, X_), dims)
+        nodeScore = tf.multiply(WX, tf.tanh(self.sigma * VX))
+
+        nodeProb = [tf.ones([1, numPoints])]
+        if self.internalNodes > 0:
+            TX = tf.tanh(tf.multiply(sigmaI, tf.matmul(self.T, X_)))
+        for level in range(1, self.treeDepth + 1):
+            # Nodes of the parent level and the sign of each child
+            parents = np.arange(2**level) // 2
+            parents += 2**(level - 1) - 1
+            sign = np.ones([2**level, 1], dtype=np.float32)
+            sign[1::2] = -1.0
+            branchProb = (1 + tf.gather(TX, parents) * sign) / 2.0
+            parentProb = tf.gather(nodeProb[-1], np.arange(2**level) // 2)
+            nodeProb.append(parentProb * branchProb)
+        self.__nodeProb = tf.concat(nodeProb, 0)
+
+        score_ = tf.multiply(tf.expand_dims(self.__nodeProb, 1), nodeScore)
+        return tf.reduce_sum(score_, 0)
+
     def getPrediction(self):
         '''
         Takes in a score tensor and outputs a integer class for each data point
@@ -8,7 +8,7 @@ import tensorflow as tf
 class ProtoNN:
     def __init__(self, inputDimension, projectionDimension, numPrototypes,
                  numOutputLabels, gamma,
-                 W = None, B = None, Z = None):
+                 W = None, B = None, Z = None, normExpansion=False):
         '''
         Forward computation graph for ProtoNN.
 
@@ -23,6 +23,12 @@ class ProtoNN:
                 W   inputDimension (d) x projectionDimension (d_cap)
                 B   projectionDimension (d_cap) x numPrototypes (m)
                 Z   numOutputLabels (L) x numPrototypes (m)
+        normExpansion: If True, the squared distances between WX and the
+            prototypes are computed as ||WX||^2 - 2 WX.B + ||B||^2 with a
+            matmul (clamped at 0), instead of broadcasting WX - B. This
+            avoids the [-1, d_cap, m] intermediate tensor of the default
+            path at the cost of some floating point cancellation for
+            points very close to a prototype.
         '''
         with tf.name_scope('protoNN') as ns:
             self.__nscope = ns
@@ -35,6 +41,7 @@ class ProtoNN:
         self.__inB = B
         self.__inZ = Z
         self.__inGamma = gamma
+        self.__normExpansion = normExpansion
         self.W, self.B, self.Z = None, None, None
         self.gamma = None
 
@@ -112,7 +119,7 @@ class ProtoNN:
         '''
         return self.W, self.B, self.Z, self.gamma
 
-    def __call__(self, X, Y=None):
+    def __call__(self, X, Y=None, normExpansion=None):
         '''
         This method is responsible for construction of the forward computation
         graph. The end point of the computation graph, or in other words the
@@ -125,34 +132,53 @@ class ProtoNN:
         can be defined by overriding the createAccOp(protoNNScoresOut, Y)
         method.
 
-        X: Input tensor or placeholder of shape [-1, inputDimension]
+        X: Input tensor or placeholder of shape [-1, inputDimension]. X can
+            also be a tf.SparseTensor (for instance a tf.sparse_placeholder),
+            in which case the projection W.X is a sparse-dense matmul.
         Y: Optional tensor or placeholder for targets (labels or classes).
             Expected shape is [-1, numOutputLabels].
+        normExpansion: Overrides the normExpansion argument of __init__ for
+            this graph (None keeps it). See __init__.
         returns: The forward computation outputs, self.protoNNOut
         '''
         # This should never execute
         assert self.__validInit is True, "Initialization failed!"
+        if normExpansion is not None:
+            msg = 'normExpansion has to be set before the graph is built'
+            assert (self.protoNNOut is None or
+                    normExpansion == self.__normExpansion), msg
+            self.__normExpansion = normExpansion
         if self.protoNNOut is not None:
             return self.protoNNOut
 
         W, B, Z, gamma = self.W, self.B, self.Z, self.gamma
         with tf.name_scope(self.__nscope):
-            WX = tf.matmul(X, W)
-            # Convert WX to tensor so that broadcasting can work
-            dim = [-1, WX.shape.as_list()[1], 1]
-            WX = tf.reshape(WX, dim)
-            dim = [1, B.shape.as_list()[0], -1]
-            B = tf.reshape(B, dim)
-            l2sim = B - WX
-            l2sim = tf.pow(l2sim, 2)
-            l2sim = tf.reduce_sum(l2sim, 1, keepdims=True)
+            if isinstance(X, tf.SparseTensor):
+                WX = tf.sparse_tensor_dense_matmul(X, W)
+            else:
+                WX = tf.matmul(X, W)
+            if self.__normExpansion:
+                l2sim = tf.reduce_sum(tf.square(WX), 1, keepdims=True)
+                l2sim = l2sim - 2 * tf.matmul(WX, B)
+                l2sim = l2sim + tf.reduce_sum(tf.square(B), 0, keepdims=True)
+                l2sim = tf.maximum(l2sim, 0.0)
+                l2sim = tf.reshape(l2sim, [-1, 1, self.__m])
+            else:
+                # Convert WX to tensor so that broadcasting can work
+                dim = [-1, WX.shape.as_list()[1], 1]
+                WX = tf.reshape(WX, dim)
+                dim = [1, B.shape.as_list()[0], -1]
+                B = tf.reshape(B, dim)
+                l2sim = B - WX
+                l2sim = tf.pow(l2sim, 2)
+                l2sim = tf.reduce_sum(l2sim, 1, keepdims=True)
             self.l2sim = l2sim
             gammal2sim = (-1 * gamma * gamma) * l2sim
             M = tf.exp(gammal2sim)
-            dim = [1] + Z.shape.as_list()
-            Z = tf.reshape(Z, dim)
-            y = tf.multiply(Z, M)
-            y = tf.reduce_sum(y, 2, name='protoNNScoreOut')
+            # Scores are M.Z^T, a [-1, m] x [m, L] matmul, which avoids a
+            # [-1, L, m] broadcast intermediate
+            M = tf.reshape(M, [-1, self.__m])
+            y = tf.matmul(M, Z, transpose_b=True, name='protoNNScoreOut')
             self.protoNNOut = y
             self.predictions = tf.argmax(y, 1, name='protoNNPredictions')
             if Y is not None:
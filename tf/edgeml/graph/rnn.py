@@ -1,6 +1,7 @@
 # Copyright (c) Microsoft Corporation. All rights reserved.
 # Licensed under the MIT license.
 
+import numpy as np
 import tensorflow as tf
 from tensorflow.python.ops import init_ops
 from tensorflow.python.ops import math_ops
@@ -363,6 +364,16 @@ class FastRNNCell(RNNCell):
         return Vars
 
 
+def _getDataModule():
+    '''
+    Returns the module defining the dataset AUTOTUNE constant:
+    tf.data.experimental, or tf.contrib.data for older versions
+    '''
+    if hasattr(tf.data, 'experimental'):
+        return tf.data.experimental
+    return tf.contrib.data
+
+
 class EMI_DataPipeline():
     '''
     The data input block for EMI-RNN training. Since EMI-RNN is an expensive
@@ -378,6 +389,10 @@ class EMI_DataPipeline():
     This class supports resuming from checkpoint files. Provide the restored
     meta graph as an argument to __init__ to enable this behaviour.
 
+    With subinstanceStride, the pipeline takes raw [-1, rawTimesteps,
+    numFeats] data and creates the overlapping subinstances of each batch in
+    the graph, so that the bagged data never has to be stored.
+
     Usage:
         Step 1: Create a data input pipeline object and obtain the x_batch and
         y_batch tensors. These should be fed to other parts of the graph that
@@ -410,7 +425,8 @@ class EMI_DataPipeline():
     '''
 
     def __init__(self, numSubinstance, numTimesteps, numFeats, numOutput,
-                 graph=None, prefetchNum=5):
+                 graph=None, prefetchNum=5, subinstanceStride=None,
+                 numCacheSlots=0, shuffleBufferSize=10000, seed=None):
         '''
         numSubinstance, numTimeSteps, numFeats, numOutput:
             Dataset characteristics. Please refer to the data preparation
@@ -420,7 +436,35 @@ class EMI_DataPipeline():
             saved metagraph can be restored using the edgeml.utils.GraphManager
             module.
         prefetchNum: The number of asynchronous prefetch to do when iterating over
-            the data. Please refer to 'prefetching' in Tensorflow dataset API
+            the data. Please refer to 'prefetching' in Tensorflow dataset API.
+            Pass None to let Tensorflow tune the prefetch buffer (AUTOTUNE).
+            Tensorflow versions without AUTOTUNE fall back to the default
+            prefetch of 5 batches.
+        subinstanceStride: If provided, the pipeline ingests raw (unbagged)
+            data of shape [-1, rawTimesteps, numFeats] and builds the bags
+            on the fly, after batching. Subinstances of numTimesteps steps
+            start every subinstanceStride steps, the last one zero padded,
+            as in examples/EMI-RNN/helpermethods.bagData. Only the raw data
+            is stored; Y is still [-1, numSubinstance, numOutput]. Pass the
+            same value when restoring from a meta graph.
+        numCacheSlots: Number of data sets that are kept in the Tensorflow
+            runtime. With numCacheSlots > 0, runInitializer copies x_data
+            and y_data into (non-trainable, non-checkpointed) variables of
+            a cache slot the first time they are seen and afterwards only
+            re-initializes the iterator over the slot. Arrays are matched by
+            identity, so pass the same numpy (or memory mapped) objects to
+            reuse a slot and do not modify them in place (see
+            clearCache). The least recently used slot is replaced when all
+            slots are in use. Pass the same value when restoring from a meta
+            graph.
+        shuffleBufferSize: Size of the shuffle buffer used when
+            runInitializer is called with shuffle=True. The data points are
+            reshuffled every epoch; memory use is bounded by the buffer
+            rather than the data set size.
+        seed: Seed of the shuffle. Every shuffled runInitializer call uses
+            seed + (number of previous shuffled calls), so a run is
+            reproducible while different iterations see different orders.
+            If None, the seeds are drawn from numpy's global random state.
         '''
 
         self.numSubinstance = numSubinstance
@@ -429,21 +473,53 @@ class EMI_DataPipeline():
         self.graph = graph
         self.prefetchNum = prefetchNum
         self.numOutput = numOutput
+        self.subinstanceStride = subinstanceStride
+        self.numCacheSlots = numCacheSlots
+        self.shuffleBufferSize = shuffleBufferSize
+        self.seed = seed
         self.graphCreated = False
         # Either restore or create the following
         self.X = None
         self.Y = None
         self.batchSize = None
         self.numEpochs = None
+        self.bufferSize = None
+        self.shuffleSeed = None
         self.dataset_init = None
+        self.cacheXInit = []
+        self.cacheYInit = []
+        self.cacheInit = []
         self.x_batch = None
         self.y_batch = None
         # Internal
         self.scope = 'EMI/'
+        self.__numShuffles = 0
+        # [x_data, y_data] currently held by each cache slot, slot order
+        # (most recently used last) and the session holding the slots
+        self.clearCache()
+
+    def __getDataset(self, X, Y, batchSize, numEpochs):
+        dataset_x_target = tf.data.Dataset.from_tensor_slices(X)
+        dataset_y_target = tf.data.Dataset.from_tensor_slices(Y)
+        couple = (dataset_x_target, dataset_y_target)
+        ds_target = tf.data.Dataset.zip(couple)
+        # Shuffling before repeat reshuffles every epoch without mixing
+        # epochs. A buffer size of 1 leaves the order unchanged.
+        ds_target = ds_target.shuffle(self.bufferSize, seed=self.shuffleSeed,
+                                      reshuffle_each_iteration=True)
+        ds_target = ds_target.repeat(numEpochs)
+        ds_target = ds_target.batch(batchSize)
+        prefetchNum = self.prefetchNum
+        if prefetchNum is None:
+            prefetchNum = getattr(_getDataModule(), 'AUTOTUNE', 5)
+        ds_target = ds_target.prefetch(prefetchNum)
+        return ds_target
 
     def _createGraph(self):
         assert self.graphCreated is False
         dim = [None, self.numSubinstance, self.numTimesteps, self.numFeats]
+        if self.subinstanceStride is not None:
+            dim = [None, None, self.numFeats]
         scope = self.scope + 'input-pipeline/'
         with tf.name_scope(scope):
             X = tf.placeholder(tf.float32, dim, name='inpX')
@@ -451,19 +527,42 @@ class EMI_DataPipeline():
                                             self.numOutput], name='inpY')
             batchSize = tf.placeholder(tf.int64, name='batch-size')
             numEpochs = tf.placeholder(tf.int64, name='num-epochs')
+            self.bufferSize = tf.placeholder_with_default(
+                tf.constant(1, dtype=tf.int64), [],
+                name='shuffle-buffer-size')
+            self.shuffleSeed = tf.placeholder_with_default(
+                tf.constant(0, dtype=tf.int64), [], name='shuffle-seed')
 
-            dataset_x_target = tf.data.Dataset.from_tensor_slices(X)
-            dataset_y_target = tf.data.Dataset.from_tensor_slices(Y)
-            couple = (dataset_x_target, dataset_y_target)
-            ds_target = tf.data.Dataset.zip(couple).repeat(numEpochs)
-            ds_target = ds_target.batch(batchSize)
-            ds_target = ds_target.prefetch(self.prefetchNum)
+            ds_target = self.__getDataset(X, Y, batchSize, numEpochs)
             ds_iterator_target = tf.data.Iterator.from_structure(ds_target.output_types,
                                                                  ds_target.output_shapes)
             ds_next_target = ds_iterator_target
             ds_init_target = ds_iterator_target.make_initializer(ds_target,
                                                                  name='dataset-init')
+            for i in range(self.numCacheSlots):
+                # The data is assigned from the placeholders once and stays
+                # out of all collections (not saved or initialized with the
+                # model)
+                cacheX = tf.Variable(X, trainable=False, collections=[],
+                                     validate_shape=False,
+                                     name='cache-x-%d' % i)
+                cacheY = tf.Variable(Y, trainable=False, collections=[],
+                                     validate_shape=False,
+                                     name='cache-y-%d' % i)
+                cacheXVal = tf.identity(cacheX)
+                cacheXVal.set_shape(X.get_shape())
+                cacheYVal = tf.identity(cacheY)
+                cacheYVal.set_shape(Y.get_shape())
+                ds_cache = self.__getDataset(cacheXVal, cacheYVal,
+                                             batchSize, numEpochs)
+                initOp = ds_iterator_target.make_initializer(
+                    ds_cache, name='dataset-init-cache-%d' % i)
+                self.cacheXInit.append(cacheX.initializer)
+                self.cacheYInit.append(cacheY.initializer)
+                self.cacheInit.append(initOp)
             x_batch, y_batch = ds_iterator_target.get_next()
+            if self.subinstanceStride is not None:
+                x_batch = self.__bagBatch(x_batch)
             tf.add_to_collection('next-x-batch', x_batch)
             tf.add_to_collection('next-y-batch', y_batch)
         self.X = X
@@ -474,6 +573,25 @@ class EMI_DataPipeline():
         self.x_batch, self.y_batch = x_batch, y_batch
         self.graphCreated = True
 
+    def __bagBatch(self, x_batch):
+        '''
+        Converts a batch of raw data [-1, rawTimesteps, numFeats] into
+        bags [-1, numSubinstance, numTimesteps, numFeats] with a single
+        gather over the (zero padded) time axis.
+        '''
+        # Number of time steps spanned by the subinstances
+        bagLen = (self.numSubinstance - 1) * self.subinstanceStride
+        bagLen += self.numTimesteps
+        rawLen = tf.shape(x_batch)[1]
+        padLen = tf.maximum(bagLen - rawLen, 0)
+        x_batch = tf.pad(x_batch, [[0, 0], [0, padLen], [0, 0]])
+        index = np.arange(self.numSubinstance)[:, None]
+        index = index * self.subinstanceStride
+        index = index + np.arange(self.numTimesteps)[None, :]
+        x_batch = tf.gather(x_batch, index.astype(np.int32), axis=1)
+        dim = [-1, self.numSubinstance, self.numTimesteps, self.numFeats]
+        return tf.reshape(x_batch, dim)
+
     def _restoreGraph(self, graph):
         assert self.graphCreated is False
         scope = 'EMI/input-pipeline/'
@@ -481,7 +599,20 @@ class EMI_DataPipeline():
         self.Y = graph.get_tensor_by_name(scope + "inpY:0")
         self.batchSize = graph.get_tensor_by_name(scope + "batch-size:0")
         self.numEpochs = graph.get_tensor_by_name(scope + "num-epochs:0")
+        self.bufferSize = graph.get_tensor_by_name(scope +
+                                                   "shuffle-buffer-size:0")
+        self.shuffleSeed = graph.get_tensor_by_name(scope + "shuffle-seed:0")
         self.dataset_init = graph.get_operation_by_name(scope + "dataset-init")
+        self.cacheXInit, self.cacheYInit, self.cacheInit = [], [], []
+        for i in range(self.numCacheSlots):
+            self.cacheXInit.append(graph.get_operation_by_name(
+                scope + "cache-x-%d/Assign" % i))
+            self.cacheYInit.append(graph.get_operation_by_name(
+                scope + "cache-y-%d/Assign" % i))
+            self.cacheInit.append(graph.get_operation_by_name(
+                scope + "dataset-init-cache-%d" % i))
+        # Variables of a restored graph are not initialized
+        self.clearCache()
         self.x_batch = graph.get_collection('next-x-batch')
         self.y_batch = graph.get_collection('next-y-batch')
         msg = 'More than one tensor named next-x-batch/next-y-batch. '
@@ -525,7 +656,8 @@ class EMI_DataPipeline():
         self._restoreGraph(graph)
         assert self.graphCreated is True
 
-    def runInitializer(self, sess, x_data, y_data, batchSize, numEpochs):
+    def runInitializer(self, sess, x_data, y_data, batchSize, numEpochs,
+                       shuffle=False):
         '''
         This method is used to ingest data by the dataset API. Call this method
         with the data matrices after the graph has been initialized.
@@ -534,26 +666,89 @@ class EMI_DataPipeline():
         numEpochs: The Tensorflow dataset API implements iteration over epochs
             by appending the data to itself numEpochs times and then iterating
             over the resulting data as if it was a single data set.
+        shuffle: If True, the data points are shuffled every epoch with a
+            buffer of shuffleBufferSize points. Leave False for evaluation,
+            where outputs are expected in the order of x_data.
         '''
         assert self.graphCreated is True
-        msg = 'X shape should be [-1, numSubinstance, numTimesteps, numFeats]'
-        assert x_data.ndim == 4, msg
-        assert x_data.shape[1] == self.numSubinstance, msg
-        assert x_data.shape[2] == self.numTimesteps, msg
-        assert x_data.shape[3] == self.numFeats, msg
+        if self.subinstanceStride is not None:
+            msg = 'X shape should be [-1, rawTimesteps, numFeats]'
+            assert x_data.ndim == 3, msg
+            assert x_data.shape[2] == self.numFeats, msg
+            rawLen = x_data.shape[1]
+            assert rawLen >= self.numTimesteps, msg
+            numSubinstance = 1
+            if rawLen > self.numTimesteps:
+                numSubinstance += -(-(rawLen - self.numTimesteps) //
+                                    self.subinstanceStride)
+            msg = 'rawTimesteps does not give numSubinstance subinstances'
+            assert numSubinstance == self.numSubinstance, msg
+        else:
+            msg = 'X shape should be [-1, numSubinstance, numTimesteps, '
+            msg += 'numFeats]'
+            assert x_data.ndim == 4, msg
+            assert x_data.shape[1] == self.numSubinstance, msg
+            assert x_data.shape[2] == self.numTimesteps, msg
+            assert x_data.shape[3] == self.numFeats, msg
         msg = 'X and Y sould have same first dimension'
         assert y_data.shape[0] == x_data.shape[0], msg
         msg = 'Y shape should be [-1, numSubinstance, numOutput]'
         assert y_data.shape[1] == self.numSubinstance, msg
         assert y_data.shape[2] == self.numOutput, msg
-        feed_dict = {
-            self.X: x_data,
-            self.Y: y_data,
-            self.batchSize: batchSize,
-            self.numEpochs: numEpochs
-        }
         assert self.dataset_init is not None, 'Internal error!'
-        sess.run(self.dataset_init, feed_dict=feed_dict)
+        feed_dict = {self.batchSize: batchSize, self.numEpochs: numEpochs}
+        if shuffle:
+            if self.seed is None:
+                seed = np.random.randint(1, 2**31 - 1)
+            else:
+                seed = self.seed + self.__numShuffles
+            self.__numShuffles += 1
+            feed_dict[self.bufferSize] = self.shuffleBufferSize
+            feed_dict[self.shuffleSeed] = seed
+        if self.numCacheSlots == 0:
+            feed_dict[self.X] = x_data
+            feed_dict[self.Y] = y_data
+            sess.run(self.dataset_init, feed_dict=feed_dict)
+            return
+        if sess is not self.__cacheSession:
+            self.clearCache()
+            self.__cacheSession = sess
+        slot = self.__getCacheSlot(x_data, y_data)
+        if self.__cachedData[slot][0] is not x_data:
+            sess.run(self.cacheXInit[slot], feed_dict={self.X: x_data})
+            self.__cachedData[slot][0] = x_data
+        if self.__cachedData[slot][1] is not y_data:
+            sess.run(self.cacheYInit[slot], feed_dict={self.Y: y_data})
+            self.__cachedData[slot][1] = y_data
+        sess.run(self.cacheInit[slot], feed_dict=feed_dict)
+
+    def __getCacheSlot(self, x_data, y_data):
+        '''
+        Returns the slot holding x_data (preferring one that also holds
+        y_data) or the least recently used slot otherwise
+        '''
+        candidates = [i for i in self.__cacheOrder
+                      if self.__cachedData[i][0] is x_data]
+        if len(candidates) == 0:
+            slot = self.__cacheOrder[0]
+        else:
+            slot = candidates[-1]
+            for i in candidates:
+                if self.__cachedData[i][1] is y_data:
+                    slot = i
+        self.__cacheOrder.remove(slot)
+        self.__cacheOrder.append(slot)
+        return slot
+
+    def clearCache(self):
+        '''
+        Forgets the data sets held by the cache slots. The next
+        runInitializer call copies its data again. Call this after modifying
+        an array passed to runInitializer in place.
+        '''
+        self.__cachedData = [[None, None] for i in range(self.numCacheSlots)]
+        self.__cacheOrder = list(range(self.numCacheSlots))
+        self.__cacheSession = None
 
 
 class EMI_RNN():
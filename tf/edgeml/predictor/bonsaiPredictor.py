@@ -0,0 +1,223 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+
+import numpy as np
+import edgeml.predictor.sparseUtils as sparseUtils
+
+
+class BonsaiPredictor:
+
+    def __init__(self, numClasses, dataDimension, projectionDimension,
+                 treeDepth, sigma, W, T, V, Z, densityThreshold=0.5):
+        '''
+        Pure numpy inference engine for a trained Bonsai model.
+
+        At inference time sigmaI is infinite and the node probabilities of
+        Bonsai are indicators, so a data point reaches a single leaf unless
+        T.X_ is exactly 0 at some node (for instance for rows of T zeroed by
+        hard thresholding). Instead of evaluating all totalNodes nodes like
+        the training graph does, each data point is routed down its
+        root-to-leaf path and W, V are evaluated only for the nodes on that
+        path. On a tie (T.X_ == 0) tanh(sigmaI * T.X_) is 0 in the training
+        graph, so the point continues down both subtrees with weight 0.5 each.
+
+        Expected Dimensions: (same as edgeml.graph.bonsai.Bonsai)
+        W [numClasses*totalNodes, projectionDimension]
+        V [numClasses*totalNodes, projectionDimension]
+        Z [projectionDimension, dataDimension]
+        T [internalNodes, projectionDimension]
+
+        numClasses will be reset to 1 in binary case
+
+        densityThreshold: Parameter matrices (hard thresholded during
+            training) with a fraction of non-zeros below this value are stored
+            as CSR matrices and evaluated with sparse-dense products. Set to
+            0 to always use dense products.
+        '''
+        self.dataDimension = dataDimension
+        self.projectionDimension = projectionDimension
+
+        if numClasses == 2:
+            self.numClasses = 1
+        else:
+            self.numClasses = numClasses
+
+        self.treeDepth = treeDepth
+        self.sigma = sigma
+
+        self.internalNodes = 2**self.treeDepth - 1
+        self.totalNodes = 2 * self.internalNodes + 1
+
+        self.W = np.asarray(W, dtype=np.float32)
+        self.V = np.asarray(V, dtype=np.float32)
+        self.T = np.asarray(T, dtype=np.float32)
+        self.Z = np.asarray(Z, dtype=np.float32)
+
+        self.assertInit()
+
+        self.densityThreshold = densityThreshold
+        W = sparseUtils.toSparse(self.W, densityThreshold)
+        V = sparseUtils.toSparse(self.V, densityThreshold)
+        T = sparseUtils.toSparse(self.T, densityThreshold)
+        self._Z = sparseUtils.toSparse(self.Z, densityThreshold)
+
+        # Per node [numClasses, projectionDimension] blocks of W and V and
+        # [1, projectionDimension] rows of T
+        self._Wnodes = [W[i * self.numClasses:(i + 1) * self.numClasses]
+                        for i in range(self.totalNodes)]
+        self._Vnodes = [V[i * self.numClasses:(i + 1) * self.numClasses]
+                        for i in range(self.totalNodes)]
+        self._Tnodes = [T[i:i + 1] for i in range(self.internalNodes)]
+
+    @classmethod
+    def loadModel(cls, currDir, densityThreshold=0.5):
+        '''
+        Creates a predictor from the parameter matrices and hyper parameters
+        written by BonsaiTrainer.saveParams into currDir
+        '''
+        paramDir = currDir + '/'
+        W = np.load(paramDir + "W.npy")
+        V = np.load(paramDir + "V.npy")
+        T = np.load(paramDir + "T.npy")
+        Z = np.load(paramDir + "Z.npy")
+        hyperParamDict = np.load(paramDir + "hyperParam.npy",
+                                 allow_pickle=True).item()
+        return cls(hyperParamDict['numClasses'], hyperParamDict['dataDim'],
+                   hyperParamDict['projDim'], hyperParamDict['depth'],
+                   hyperParamDict['sigma'], W, T, V, Z,
+                   densityThreshold=densityThreshold)
+
+    def project(self, X):
+        '''
+        Returns the projected data X_ = Z.X / projectionDimension
+
+        X is [_, dataDimension], X_ is [projectionDimension, _]
+        '''
+        errmsg = "Dimension Mismatch, X is [_, self.dataDimension]"
+        assert (X.ndim == 2 and X.shape[1] == self.dataDimension), errmsg
+        return sparseUtils.dot(self._Z, X.T) / self.projectionDimension
+
+    def __call__(self, X, batchSize=None):
+        '''
+        Returns the Bonsai score of X. Equivalent to the score of the training
+        graph with sigmaI = infinity, including points with T.X_ == 0 at some
+        node, which are scored in both subtrees with weight 0.5.
+
+        X is [_, dataDimension]
+        batchSize: Number of data points scored at once. Defaults to all.
+
+        returns score [numClasses, _]
+        '''
+        numPoints = X.shape[0]
+        if batchSize is None or batchSize >= numPoints:
+            return self.__score(X)[0]
+        score = np.empty([self.numClasses, numPoints], dtype=np.float32)
+        for start in range(0, numPoints, batchSize):
+            end = min(start + batchSize, numPoints)
+            score[:, start:end] = self.__score(X[start:end])[0]
+        return score
+
+    def getPath(self, X):
+        '''
+        Returns the indices of the nodes visited by each data point,
+        root first. Where T.X_ == 0 the point is scored in both subtrees
+        (see __init__) but only the right child is reported here.
+
+        X is [_, dataDimension], returns [_, treeDepth + 1]
+        '''
+        return self.__score(X)[1].T
+
+    def predict(self, X, batchSize=None):
+        '''
+        Returns an integer class for each data point in X. In the binary case
+        class 1 corresponds to a positive score.
+        '''
+        score = self(X, batchSize=batchSize)
+        if self.numClasses > 2:
+            return np.argmax(score, axis=0)
+        return (score[0] > 0).astype(int)
+
+    def __score(self, X):
+        X_ = self.project(X)
+        numPoints = X_.shape[1]
+        score = np.zeros([self.numClasses, numPoints], dtype=np.float32)
+        path = np.empty([self.treeDepth + 1, numPoints], dtype=np.int64)
+        # node -> (points reaching the node, their node probabilities and
+        # whether the node is on the reported path of the point)
+        allPoints = np.arange(numPoints)
+        levelNodes = {0: (allPoints, np.ones(numPoints, dtype=np.float32),
+                          np.ones(numPoints, dtype=bool))}
+        for level in range(self.treeDepth + 1):
+            nextNodes = {}
+            for i in sorted(levelNodes.keys()):
+                index, prob, onPath = levelNodes[i]
+                path[level, index[onPath]] = i
+                X_i = X_[:, index]
+                WX = sparseUtils.dot(self._Wnodes[i], X_i)
+                VX = sparseUtils.dot(self._Vnodes[i], X_i)
+                score[:, index] += prob * WX * np.tanh(self.sigma * VX)
+                if level == self.treeDepth:
+                    continue
+                # Go left if T.X_ > 0, right if T.X_ < 0 and both ways with
+                # half the probability if T.X_ == 0
+                thetaX = sparseUtils.dot(self._Tnodes[i], X_i)[0]
+                tie = (thetaX == 0)
+                childProb = np.where(tie, 0.5 * prob, prob)
+                left = (thetaX >= 0)
+                right = (thetaX <= 0)
+                nextNodes[2 * i + 1] = (index[left], childProb[left],
+                                        (onPath & (thetaX > 0))[left])
+                nextNodes[2 * i + 2] = (index[right], childProb[right],
+                                        onPath[right])
+            levelNodes = dict((k, v) for k, v in nextNodes.items()
+                              if len(v[0]) > 0)
+        return score, path
+
+    def getFlopCount(self):
+        '''
+        Returns the number of floating point operations of the matrix products
+        needed to score one data point, for the most expensive root-to-leaf
+        path (points with T.X_ == 0 at a node also evaluate the other
+        subtree). Returns both the count based on the non-zeros actually stored
+        and the count of an all dense evaluation.
+
+        returns flops, denseFlops
+        '''
+        nodeFlops = np.zeros(self.totalNodes)
+        for i in range(self.totalNodes):
+            nodeFlops[i] = 2 * (sparseUtils.countnnZ(self._Wnodes[i]) +
+                                sparseUtils.countnnZ(self._Vnodes[i]))
+            if i < self.internalNodes:
+                nodeFlops[i] += 2 * sparseUtils.countnnZ(self._Tnodes[i])
+        # Cost of the path from the root to each node
+        for i in range(1, self.totalNodes):
+            nodeFlops[i] += nodeFlops[(i - 1) // 2]
+        flops = 2 * sparseUtils.countnnZ(self._Z)
+        flops += np.max(nodeFlops[self.internalNodes:])
+
+        p = self.projectionDimension
+        denseFlops = 2 * p * self.dataDimension
+        denseFlops += (self.treeDepth + 1) * 4 * self.numClasses * p
+        denseFlops += self.treeDepth * 2 * p
+        return int(flops), int(denseFlops)
+
+    def assertInit(self):
+        errRank = "All Parameters must has only two dimensions shape = [a, b]"
+        assert self.W.ndim == 2, errRank
+        assert self.V.ndim == 2, errRank
+        assert self.Z.ndim == 2, errRank
+        assert self.T.ndim == 2, errRank
+        msg = "W and V should be of same Dimensions"
+        assert self.W.shape == self.V.shape, msg
+        errW = "W and V are [numClasses*totalNodes, projectionDimension]"
+        assert self.W.shape[0] == self.numClasses * self.totalNodes, errW
+        assert self.W.shape[1] == self.projectionDimension, errW
+        errZ = "Z is [projectionDimension, dataDimension]"
+        assert self.Z.shape[0] == self.projectionDimension, errZ
+        assert self.Z.shape[1] == self.dataDimension, errZ
+        errT = "T is [internalNodes, projectionDimension]"
+        assert self.T.shape[0] == self.internalNodes, errT
+        assert self.T.shape[1] == self.projectionDimension, errT
+        assert int(self.numClasses) > 0, "numClasses should be > 1"
+        msg = "treeDepth should be >= 0"
+        assert int(self.treeDepth) >= 0, msg
@@ -0,0 +1,107 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+
+import numpy as np
+import edgeml.predictor.sparseUtils as sparseUtils
+
+
+class ProtoNNPredictor:
+
+    def __init__(self, W, B, Z, gamma, densityThreshold=0.5):
+        '''
+        Pure numpy inference engine for a trained ProtoNN model.
+
+        W, B, Z: Numpy matrices of the trained model, as returned by
+            evaluating ProtoNN.getModelMatrices().
+            Expected Dimensions:
+                W   inputDimension (d) x projectionDimension (d_cap)
+                B   projectionDimension (d_cap) x numPrototypes (m)
+                Z   numOutputLabels (L) x numPrototypes (m)
+        gamma: The gamma of the gaussian kernel.
+        densityThreshold: Parameter matrices (hard thresholded during
+            training) with a fraction of non-zeros below this value are stored
+            as CSR/CSC matrices and evaluated with sparse-dense products. Set
+            to 0 to always use dense products.
+        '''
+        self.W = np.asarray(W, dtype=np.float32)
+        self.B = np.asarray(B, dtype=np.float32)
+        self.Z = np.asarray(Z, dtype=np.float32)
+        self.gamma = float(gamma)
+        self.__validateInit()
+
+        self.densityThreshold = densityThreshold
+        # X.W and WX.B are computed as (W^T X^T)^T and (B^T WX^T)^T by
+        # sparseUtils.dot, hence W and B are stored as CSC (transposes CSR)
+        self._W = sparseUtils.toSparse(self.W, densityThreshold, 'csc')
+        self._B = sparseUtils.toSparse(self.B, densityThreshold, 'csc')
+        self._Z = sparseUtils.toSparse(self.Z, densityThreshold, 'csr')
+        self._BNorm = np.sum(np.square(self.B), axis=0, keepdims=True)
+
+    def __validateInit(self):
+        errmsg = "Dimensions mismatch! Should be W[d, d_cap]"
+        errmsg += ", B[d_cap, m] and Z[L, m]"
+        assert self.W.ndim == 2, errmsg
+        assert self.B.ndim == 2, errmsg
+        assert self.Z.ndim == 2, errmsg
+        assert self.W.shape[1] == self.B.shape[0], errmsg
+        assert self.B.shape[1] == self.Z.shape[1], errmsg
+
+    def getHyperParams(self):
+        '''
+        Returns the model hyperparameters:
+            [inputDimension, projectionDimension,
+            numPrototypes, numOutputLabels, gamma]
+        '''
+        d, d_cap = self.W.shape
+        L, m = self.Z.shape
+        return d, d_cap, m, L, self.gamma
+
+    def __call__(self, X, batchSize=None):
+        '''
+        Returns the ProtoNN scores of X.
+
+        X: [-1, inputDimension]
+        batchSize: Number of data points scored at once. Defaults to all.
+
+        returns [-1, numOutputLabels]
+        '''
+        d, _, _, L, _ = self.getHyperParams()
+        errmsg = "Dimension Mismatch, X is [-1, inputDimension]"
+        assert (X.ndim == 2 and X.shape[1] == d), errmsg
+        numPoints = X.shape[0]
+        if batchSize is None or batchSize >= numPoints:
+            return self.__score(X)
+        score = np.empty([numPoints, L], dtype=np.float32)
+        for start in range(0, numPoints, batchSize):
+            end = min(start + batchSize, numPoints)
+            score[start:end] = self.__score(X[start:end])
+        return score
+
+    def predict(self, X, batchSize=None):
+        '''
+        Returns argmax(protoNNScores) for each data point in X
+        '''
+        return np.argmax(self(X, batchSize=batchSize), axis=1)
+
+    def __score(self, X):
+        WX = sparseUtils.dot(X, self._W)
+        # ||WX - B||^2 = ||WX||^2 - 2 WX.B + ||B||^2
+        l2sim = np.sum(np.square(WX), axis=1, keepdims=True)
+        l2sim = l2sim - 2 * sparseUtils.dot(WX, self._B) + self._BNorm
+        l2sim = np.maximum(l2sim, 0.0)
+        M = np.exp((-1 * self.gamma * self.gamma) * l2sim)
+        return sparseUtils.dot(M, self._Z.T)
+
+    def getFlopCount(self):
+        '''
+        Returns the number of floating point operations of the matrix products
+        needed to score one data point. Returns both the count based on the
+        non-zeros actually stored and the count of an all dense evaluation.
+
+        returns flops, denseFlops
+        '''
+        flops = 2 * (sparseUtils.countnnZ(self._W) +
+                     sparseUtils.countnnZ(self._B) +
+                     sparseUtils.countnnZ(self._Z))
+        denseFlops = 2 * (self.W.size + self.B.size + self.Z.size)
+        return int(flops), int(denseFlops)
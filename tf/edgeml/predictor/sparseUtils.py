@@ -0,0 +1,45 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+
+import numpy as np
+import scipy.sparse as sparse
+
+
+def toSparse(A, densityThreshold=0.5, format='csr'):
+    '''
+    Returns A as a scipy.sparse matrix (csr or csc) if the fraction of
+    non-zeros in A is below densityThreshold. Otherwise returns A as a dense
+    float32 numpy array.
+    '''
+    if sparse.issparse(A):
+        A = A.toarray()
+    A = np.asarray(A, dtype=np.float32)
+    if A.size > 0 and np.count_nonzero(A) < densityThreshold * A.size:
+        return sparse.csr_matrix(A).asformat(format)
+    return A
+
+
+def dot(A, B):
+    '''
+    Matrix product of A and B where either of them can be a dense numpy array
+    or a scipy.sparse matrix. Always returns a dense numpy array.
+    '''
+    if sparse.issparse(A):
+        out = A.dot(B)
+    elif sparse.issparse(B):
+        # dense x sparse is computed as (B^T A^T)^T to use the sparse kernel
+        out = B.T.dot(A.T).T
+    else:
+        return np.dot(A, B)
+    if sparse.issparse(out):
+        out = out.toarray()
+    return np.asarray(out)
+
+
+def countnnZ(A):
+    '''
+    Returns the number of non-zeros in A (dense or sparse)
+    '''
+    if sparse.issparse(A):
+        return int(A.count_nonzero())
+    return int(np.count_nonzero(A))
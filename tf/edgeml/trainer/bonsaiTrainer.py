@@ -9,20 +9,66 @@ import os
 import sys
 
 
+class SigmaIAnnealing:
+    '''
+    The annealing schedule of sigmaI (the sharpness of the node indicators)
+    used by BonsaiTrainer. Every updateInterval iterations of a training
+    phase, sigmaI is re-estimated from the mean of |T.X_| over numSamples
+    random training points:
+
+        sigmaI = min(maxSigmaI, scale / mean|T.X_| *
+                     2^(itersInPhase / (totalBatches / numDoublings)))
+
+    Other schedules can be passed to BonsaiTrainer.train, they only need the
+    updateInterval and numSamples attributes and the same __call__.
+    '''
+
+    def __init__(self, updateInterval=100, numSamples=100, scale=0.1,
+                 maxSigmaI=1000, numDoublings=30):
+        self.updateInterval = updateInterval
+        self.numSamples = numSamples
+        self.scale = scale
+        self.maxSigmaI = maxSigmaI
+        self.numDoublings = numDoublings
+
+    def __call__(self, meanAbsTX, itersInPhase, totalBatches):
+        '''
+        meanAbsTX: Mean of |T.X_| over the sampled points and internal
+            nodes. None if the tree has no internal nodes.
+        itersInPhase: Iterations since the current training phase started.
+        totalBatches: Total number of training iterations.
+
+        returns the new value of sigmaI
+        '''
+        if meanAbsTX is None:
+            sigmaI = self.scale
+        else:
+            sigmaI = self.scale / meanAbsTX
+        sigmaI *= 2**(float(itersInPhase) /
+                      (float(totalBatches) / self.numDoublings))
+        return min(self.maxSigmaI, sigmaI)
+
+
 class BonsaiTrainer:
 
     def __init__(self, bonsaiObj, lW, lT, lV, lZ, sW, sT, sV, sZ,
-                 learningRate, X, Y, useMCHLoss=False, outFile=None):
+                 learningRate, X, Y, useMCHLoss=False, outFile=None,
+                 inGraphIHT=False):
         '''
         bonsaiObj - Initialised Bonsai Object and Graph
         lW, lT, lV and lZ are regularisers to Bonsai Params
         sW, sT, sV and sZ are sparsity factors to Bonsai Params
         learningRate - learningRate fro optimizer
         X is the Data Placeholder - Dims [_, dataDimension]
+        X can be a tf.sparse_placeholder, in which case the train and test
+        data are expected as scipy.sparse matrices (CSR)
         Y - Label placeholder for loss computation
         useMCHLoss - For choice between HingeLoss vs CrossEntropy
         useMCHLoss - True - MultiClass - multiClassHingeLoss
         useMCHLoss - False - MultiClass - crossEntropyLoss
+        inGraphIHT - If True, hard thresholding and sparse retraining run as
+        graph ops (utils.getHardThresholdOps) without moving the parameters
+        to the host
         '''
 
         self.bonsaiObj = bonsaiObj
@@ -39,6 +85,7 @@ class BonsaiTrainer:
 
         self.Y = Y
         self.X = X
+        self.isSparseInput = isinstance(X, tf.SparseTensor)
 
         self.useMCHLoss = useMCHLoss
 
@@ -54,6 +101,9 @@ class BonsaiTrainer:
         self.sigmaI = tf.placeholder(tf.float32, name='sigmaI')
 
         self.score, self.X_ = self.bonsaiObj(self.X, self.sigmaI)
+        # Used for the sigmaI annealing schedule
+        self.meanAbsTX = tf.reduce_mean(
+            tf.abs(tf.matmul(self.bonsaiObj.T, self.X_)))
 
         self.loss, self.marginLoss, self.regLoss = self.lossGraph()
 
@@ -69,6 +119,20 @@ class BonsaiTrainer:
         self.hardThrsd()
         self.sparseTraining()
 
+        # Thresholds of the previous IHT step are reused as warm starts
+        self.__thresholderW = utils.HardThresholder(self.sW)
+        self.__thresholderV = utils.HardThresholder(self.sV)
+        self.__thresholderZ = utils.HardThresholder(self.sZ)
+        self.__thresholderT = utils.HardThresholder(self.sT)
+
+        self.inGraphIHT = inGraphIHT
+        if self.inGraphIHT is True:
+            self.__ihtOp, self.__sparseRetrainOp = utils.getHardThresholdOps(
+                [self.bonsaiObj.W, self.bonsaiObj.V,
+                 self.bonsaiObj.Z, self.bonsaiObj.T],
+                [self.sW, self.sV, self.sZ, self.sT],
+                name='bonsai-hard-threshold')
+
     def lossGraph(self):
         '''
         Loss Graph for given Bonsai Obj
@@ -156,15 +220,25 @@ class BonsaiTrainer:
         '''
         Function to run the IHT routine on Bonsai Obj
         '''
+        if self.inGraphIHT is True:
+            sess.run(self.__ihtOp)
+            return
+
         currW = self.bonsaiObj.W.eval()
         currV = self.bonsaiObj.V.eval()
         currZ = self.bonsaiObj.Z.eval()
         currT = self.bonsaiObj.T.eval()
 
-        self.__thrsdW = utils.hardThreshold(currW, self.sW)
-        self.__thrsdV = utils.hardThreshold(currV, self.sV)
-        self.__thrsdZ = utils.hardThreshold(currZ, self.sZ)
-        self.__thrsdT = utils.hardThreshold(currT, self.sT)
+        self.__thrsdW = self.__thresholderW(currW, inplace=True)
+        self.__thrsdV = self.__thresholderV(currV, inplace=True)
+        self.__thrsdZ = self.__thresholderZ(currZ, inplace=True)
+        self.__thrsdT = self.__thresholderT(currT, inplace=True)
+
+        # Supports are kept for the sparse retraining steps
+        self.__supportW = utils.SupportMask(self.__thrsdW)
+        self.__supportV = utils.SupportMask(self.__thrsdV)
+        self.__supportZ = utils.SupportMask(self.__thrsdZ)
+        self.__supportT = utils.SupportMask(self.__thrsdT)
 
         fd_thrsd = {self.__Wth: self.__thrsdW, self.__Vth: self.__thrsdV,
                     self.__Zth: self.__thrsdZ, self.__Tth: self.__thrsdT}
@@ -174,20 +248,33 @@ class BonsaiTrainer:
         '''
         Function to run the Sparse Retraining routine on Bonsai Obj
         '''
+        if self.inGraphIHT is True:
+            sess.run(self.__sparseRetrainOp)
+            return
+
         currW = self.bonsaiObj.W.eval()
         currV = self.bonsaiObj.V.eval()
         currZ = self.bonsaiObj.Z.eval()
         currT = self.bonsaiObj.T.eval()
 
-        newW = utils.copySupport(self.__thrsdW, currW)
-        newV = utils.copySupport(self.__thrsdV, currV)
-        newZ = utils.copySupport(self.__thrsdZ, currZ)
-        newT = utils.copySupport(self.__thrsdT, currT)
+        newW = self.__supportW(currW, inplace=True)
+        newV = self.__supportV(currV, inplace=True)
+        newZ = self.__supportZ(currZ, inplace=True)
+        newT = self.__supportT(currT, inplace=True)
 
         fd_st = {self.__Wth: newW, self.__Vth: newV,
                  self.__Zth: newZ, self.__Tth: newT}
         sess.run(self.sparseRetrainGroup, feed_dict=fd_st)
 
+    def getFeedValue(self, X):
+        '''
+        Returns the value to be fed to the X placeholder for data X. Sparse
+        data is converted into a tf.SparseTensorValue for sparse placeholders.
+        '''
+        if self.isSparseInput is True:
+            return utils.getSparseTensorValue(X)
+        return X
+
     def assertInit(self):
         err = "sparsity must be between 0 and 1"
         assert self.sW >= 0 and self.sW <= 1, "W " + err
@@ -246,11 +333,90 @@ class BonsaiTrainer:
         hasSparse = (sparseW or sparseV or sparseT or sparseZ)
         return totalnnZ, totalSize, hasSparse
 
+    def __getBatchFeedValue(self, batchX, batchY):
+        batchY = np.reshape(batchY, [-1, self.bonsaiObj.numClasses])
+        return self.getFeedValue(batchX), batchY
+
+    def __getValidationBatches(self, numRows, valBatchSize, valSubsample):
+        '''
+        Returns the row indices (or slices) of the chunks of the validation
+        set, optionally of a fixed random sub-sample of a fraction
+        valSubsample of the rows. Only the indices are kept; the chunks are
+        read and converted when they are evaluated.
+        '''
+        index = None
+        if valSubsample is not None and valSubsample < 1:
+            numSamples = int(round(valSubsample * numRows))
+            index = np.sort(np.random.choice(numRows, numSamples,
+                                             replace=False))
+            numRows = numSamples
+        if numRows == 0:
+            raise ValueError('The validation set (or its sub-sample) ' +
+                             'has no rows')
+        if valBatchSize is None:
+            valBatchSize = numRows
+        valBatches = []
+        for start in range(0, numRows, valBatchSize):
+            if index is None:
+                valBatches.append(slice(start, start + valBatchSize))
+            else:
+                valBatches.append(index[start:start + valBatchSize])
+        return valBatches
+
+    def __runValidation(self, sess, Xtest, Ytest, valBatches, sigmaI):
+        '''
+        Evaluates the model on the validation chunks and returns accuracy,
+        loss and regularisation loss over the whole set. Accuracy and margin
+        loss are batch means, so they are accumulated weighted by the chunk
+        sizes. The regularisation loss only depends on the parameters.
+        Only one chunk is held in memory at a time.
+        '''
+        if len(valBatches) == 0:
+            raise ValueError('The validation set has no rows')
+        numRows = 0
+        accuracy, marginLoss, regLoss = 0.0, 0.0, 0.0
+        for rows in valBatches:
+            batchX, batchY = self.__getBatchFeedValue(Xtest[rows],
+                                                      Ytest[rows])
+            _feed_dict = {self.X: batchX, self.Y: batchY,
+                          self.sigmaI: sigmaI}
+            if self.bonsaiObj.numClasses > 2 and self.useMCHLoss is True:
+                _feed_dict[self.batch_th] = batchY.shape[0]
+            batchAcc, batchMarginLoss, regLoss = sess.run(
+                [self.accuracy, self.marginLoss, self.regLoss],
+                feed_dict=_feed_dict)
+            accuracy += batchAcc * batchY.shape[0]
+            marginLoss += batchMarginLoss * batchY.shape[0]
+            numRows += batchY.shape[0]
+        accuracy /= numRows
+        marginLoss /= numRows
+        return accuracy, marginLoss + regLoss, regLoss
+
     def train(self, batchSize, totalEpochs, sess,
-              Xtrain, Xtest, Ytrain, Ytest, dataDir, currDir):
+              Xtrain, Xtest, Ytrain, Ytest, dataDir, currDir,
+              shuffle=False, prefetch=2, valBatchSize=None, valStep=1,
+              valSubsample=None, sigmaISchedule=None):
         '''
         The Dense - IHT - Sparse Retrain Routine for Bonsai Training
+
+        shuffle: If True, the training data is visited in a new random order
+            every epoch
+        prefetch: Number of mini-batches prepared ahead on a background
+            thread (see utils.BatchFeeder). 0 disables prefetching.
+        valBatchSize: The test set is evaluated in chunks of valBatchSize
+            rows and the metrics are accumulated. Defaults to a single chunk.
+        valStep: The test set is evaluated every valStep epochs (and always
+            after the last epoch).
+        valSubsample: If set (0 < valSubsample <= 1), only a fixed random
+            sub-sample of this fraction of the test rows is used for
+            evaluation.
+        sigmaISchedule: Annealing schedule of sigmaI. Defaults to
+            SigmaIAnnealing().
         '''
+        if valSubsample is not None:
+            assert 0 < valSubsample <= 1, 'valSubsample should be in (0, 1]'
+        if sigmaISchedule is None:
+            sigmaISchedule = SigmaIAnnealing()
         resultFile = open(dataDir + '/TFBonsaiResults.txt', 'a+')
         numIters = Xtrain.shape[0] / batchSize
 
@@ -272,142 +438,133 @@ class BonsaiTrainer:
             itersInPhase = 0
 
         header = '*' * 20
-        for i in range(totalEpochs):
-            print("\nEpoch Number: " + str(i), file=self.outFile)
-
-            trainAcc = 0.0
-            trainLoss = 0.0
-
-            numIters = int(numIters)
-            for j in range(numIters):
-
-                if counter == 0:
-                    msg = " Dense Training Phase Started "
-                    print("\n%s%s%s\n" %
-                          (header, msg, header), file=self.outFile)
-
-                # Updating the indicator sigma
-                if ((counter == 0) or (counter == int(totalBatches / 3.0)) or
-                        (counter == int(2 * totalBatches / 3.0))) and (self.isDenseTraining is False):
-                    bonsaiObjSigmaI = 1
-                    itersInPhase = 0
-
-                elif (itersInPhase % 100 == 0):
-                    indices = np.random.choice(Xtrain.shape[0], 100)
-                    batchX = Xtrain[indices, :]
-                    batchY = Ytrain[indices, :]
-                    batchY = np.reshape(
-                        batchY, [-1, self.bonsaiObj.numClasses])
-
-                    _feed_dict = {self.X: batchX}
-                    Xcapeval = self.X_.eval(feed_dict=_feed_dict)
-                    Teval = self.bonsaiObj.T.eval()
-
-                    sum_tr = 0.0
-                    for k in range(0, self.bonsaiObj.internalNodes):
-                        sum_tr += (np.sum(np.abs(np.dot(Teval[k], Xcapeval))))
-
-                    if(self.bonsaiObj.internalNodes > 0):
-                        sum_tr /= (100 * self.bonsaiObj.internalNodes)
-                        sum_tr = 0.1 / sum_tr
-                    else:
-                        sum_tr = 0.1
-                    sum_tr = min(
-                        1000, sum_tr * (2**(float(itersInPhase) /
-                                            (float(totalBatches) / 30.0))))
-
-                    bonsaiObjSigmaI = sum_tr
-
-                itersInPhase += 1
-                batchX = Xtrain[j * batchSize:(j + 1) * batchSize]
-                batchY = Ytrain[j * batchSize:(j + 1) * batchSize]
-                batchY = np.reshape(
-                    batchY, [-1, self.bonsaiObj.numClasses])
+        valBatches = self.__getValidationBatches(Xtest.shape[0],
+                                                 valBatchSize, valSubsample)
+        batchFeeder = utils.BatchFeeder(Xtrain, Ytrain, batchSize,
+                                        totalEpochs,
+                                        numBatches=int(numIters),
+                                        shuffle=shuffle,
+                                        transform=self.__getBatchFeedValue,
+                                        prefetch=prefetch)
+        # The feeder thread is stopped even if training raises, so that it
+        # is not left blocked on a full queue
+        try:
+            for i in range(totalEpochs):
+                print("\nEpoch Number: " + str(i), file=self.outFile)
+
+                trainAcc = 0.0
+                trainLoss = 0.0
+
+                numIters = int(numIters)
+                for j in range(numIters):
+
+                    if counter == 0:
+                        msg = " Dense Training Phase Started "
+                        print("\n%s%s%s\n" %
+                              (header, msg, header), file=self.outFile)
 
-                if self.bonsaiObj.numClasses > 2:
-                    if self.useMCHLoss is True:
-                        _feed_dict = {self.X: batchX, self.Y: batchY,
-                                      self.batch_th: batchY.shape[0],
-                                      self.sigmaI: bonsaiObjSigmaI}
+                    # Updating the indicator sigma
+                    if ((counter == 0) or
+                            (counter == int(totalBatches / 3.0)) or
+                            (counter == int(2 * totalBatches / 3.0))) and \
+                            (self.isDenseTraining is False):
+                        bonsaiObjSigmaI = 1
+                        itersInPhase = 0
+
+                    elif (itersInPhase % sigmaISchedule.updateInterval == 0):
+                        meanAbsTX = None
+                        if self.bonsaiObj.internalNodes > 0:
+                            indices = np.random.choice(
+                                Xtrain.shape[0], sigmaISchedule.numSamples)
+                            batchX = Xtrain[indices, :]
+                            _feed_dict = {self.X: self.getFeedValue(batchX)}
+                            meanAbsTX = sess.run(self.meanAbsTX,
+                                                 feed_dict=_feed_dict)
+                        bonsaiObjSigmaI = sigmaISchedule(meanAbsTX,
+                                                         itersInPhase,
+                                                         totalBatches)
+
+                    itersInPhase += 1
+                    batchX, batchY = batchFeeder.getBatch()
+
+                    if self.bonsaiObj.numClasses > 2:
+                        if self.useMCHLoss is True:
+                            _feed_dict = {self.X: batchX, self.Y: batchY,
+                                          self.batch_th: batchY.shape[0],
+                                          self.sigmaI: bonsaiObjSigmaI}
+                        else:
+                            _feed_dict = {self.X: batchX, self.Y: batchY,
+                                          self.sigmaI: bonsaiObjSigmaI}
                     else:
                         _feed_dict = {self.X: batchX, self.Y: batchY,
                                       self.sigmaI: bonsaiObjSigmaI}
-                else:
-                    _feed_dict = {self.X: batchX, self.Y: batchY,
-                                  self.sigmaI: bonsaiObjSigmaI}
-
-                # Mini-batch training
-                _, batchLoss, batchAcc = sess.run(
-                    [self.trainStep, self.loss, self.accuracy],
-                    feed_dict=_feed_dict)
-
-                trainAcc += batchAcc
-                trainLoss += batchLoss
-
-                # Training routine involving IHT and sparse retraining
-                if (counter >= int(totalBatches / 3.0) and
-                    (counter < int(2 * totalBatches / 3.0)) and
-                    counter % trimlevel == 0 and
-                        self.isDenseTraining is False):
-                    self.runHardThrsd(sess)
-                    if ihtDone == 0:
-                        msg = " IHT Phase Started "
-                        print("\n%s%s%s\n" %
-                              (header, msg, header), file=self.outFile)
-                    ihtDone = 1
-                elif ((ihtDone == 1 and counter >= int(totalBatches / 3.0) and
-                       (counter < int(2 * totalBatches / 3.0)) and
-                       counter % trimlevel != 0 and
-                       self.isDenseTraining is False) or
-                        (counter >= int(2 * totalBatches / 3.0) and
-                            self.isDenseTraining is False)):
-                    self.runSparseTraining(sess)
-                    if counter == int(2 * totalBatches / 3.0):
-                        msg = " Sprase Retraining Phase Started "
-                        print("\n%s%s%s\n" %
-                              (header, msg, header), file=self.outFile)
-                counter += 1
 
-            print("Train Loss: " + str(trainLoss / numIters) +
-                  " Train accuracy: " + str(trainAcc / numIters),
-                  file=self.outFile)
-
-            oldSigmaI = bonsaiObjSigmaI
-            bonsaiObjSigmaI = 1e9
-
-            if self.bonsaiObj.numClasses > 2:
-                if self.useMCHLoss is True:
-                    _feed_dict = {self.X: Xtest, self.Y: Ytest,
-                                  self.batch_th: Ytest.shape[0],
-                                  self.sigmaI: bonsaiObjSigmaI}
-                else:
-                    _feed_dict = {self.X: Xtest, self.Y: Ytest,
-                                  self.sigmaI: bonsaiObjSigmaI}
-            else:
-                _feed_dict = {self.X: Xtest, self.Y: Ytest,
-                              self.sigmaI: bonsaiObjSigmaI}
-
-            # This helps in direct testing instead of extracting the model out
-
-            testAcc, testLoss, regTestLoss = sess.run(
-                [self.accuracy, self.loss, self.regLoss], feed_dict=_feed_dict)
-            if ihtDone == 0:
-                maxTestAcc = -10000
-                maxTestAccEpoch = i
-            else:
-                if maxTestAcc <= testAcc:
+                    # Mini-batch training
+                    _, batchLoss, batchAcc = sess.run(
+                        [self.trainStep, self.loss, self.accuracy],
+                        feed_dict=_feed_dict)
+
+                    trainAcc += batchAcc
+                    trainLoss += batchLoss
+
+                    # Training routine involving IHT and sparse retraining
+                    if (counter >= int(totalBatches / 3.0) and
+                        (counter < int(2 * totalBatches / 3.0)) and
+                        counter % trimlevel == 0 and
+                            self.isDenseTraining is False):
+                        self.runHardThrsd(sess)
+                        if ihtDone == 0:
+                            msg = " IHT Phase Started "
+                            print("\n%s%s%s\n" %
+                                  (header, msg, header), file=self.outFile)
+                        ihtDone = 1
+                    elif ((ihtDone == 1 and
+                           counter >= int(totalBatches / 3.0) and
+                           (counter < int(2 * totalBatches / 3.0)) and
+                           counter % trimlevel != 0 and
+                           self.isDenseTraining is False) or
+                            (counter >= int(2 * totalBatches / 3.0) and
+                                self.isDenseTraining is False)):
+                        self.runSparseTraining(sess)
+                        if counter == int(2 * totalBatches / 3.0):
+                            msg = " Sprase Retraining Phase Started "
+                            print("\n%s%s%s\n" %
+                                  (header, msg, header), file=self.outFile)
+                    counter += 1
+
+                print("Train Loss: " + str(trainLoss / numIters) +
+                      " Train accuracy: " + str(trainAcc / numIters),
+                      file=self.outFile)
+
+                if (i + 1) % valStep != 0 and i != totalEpochs - 1:
+                    continue
+
+                oldSigmaI = bonsaiObjSigmaI
+                bonsaiObjSigmaI = 1e9
+
+                # This helps in direct testing instead of extracting the model
+                # out
+
+                testAcc, testLoss, regTestLoss = self.__runValidation(
+                    sess, Xtest, Ytest, valBatches, bonsaiObjSigmaI)
+                if ihtDone == 0:
+                    maxTestAcc = -10000
                     maxTestAccEpoch = i
-                    maxTestAcc = testAcc
-                    self.saveParams(currDir)
-
-            print("Test accuracy %g" % testAcc, file=self.outFile)
-            print("MarginLoss + RegLoss: " + str(testLoss - regTestLoss) +
-                  " + " + str(regTestLoss) + " = " + str(testLoss) + "\n",
-                  file=self.outFile)
-            self.outFile.flush()
-
-            bonsaiObjSigmaI = oldSigmaI
-
+                else:
+                    if maxTestAcc <= testAcc:
+                        maxTestAccEpoch = i
+                        maxTestAcc = testAcc
+                        self.saveParams(currDir)
+
+                print("Test accuracy %g" % testAcc, file=self.outFile)
+                print("MarginLoss + RegLoss: " + str(testLoss - regTestLoss) +
+                      " + " + str(regTestLoss) + " = " + str(testLoss) + "\n",
+                      file=self.outFile)
+                self.outFile.flush()
+
+                bonsaiObjSigmaI = oldSigmaI
+        finally:
+            batchFeeder.close()
         # sigmaI has to be set to infinity to ensure
         # only a single path is used in inference
         bonsaiObjSigmaI = 1e9
@@ -5,6 +5,7 @@ from __future__ import print_function
 import tensorflow as tf
 import numpy as np
 import sys
+import threading
 import edgeml.utils as utils
 import pandas as pd
 
@@ -412,6 +413,60 @@ class EMI_Driver:
                 break
         return outList
 
+    def runInference(self, op, X, Y, batchSize, feedDict=None,
+                     outFile=None, lastStepOnly=False, **kwargs):
+        '''
+        Runs the tensorflow operation op, whose first dimension is the
+        batch dimension, on data X, Y and returns the results of all the
+        batches as a single array. Unlike runOps, the output array is
+        allocated once (after the first batch) and every batch is written
+        into it in place, so no list of batch results or concatenated copy
+        is created.
+
+        op: A single operation (for example softmaxPredictions).
+        X, Y: Numpy matrices of the data.
+        batchSize: batch size
+        feedDict: Feed dict required, if any, by the provided op.
+        outFile: If provided, the output is a memory mapped .npy file
+            created at this path.
+        lastStepOnly: Keep only the last time step, op[..., -1, :], of each
+            batch (for example [-1, numSubinstance, numClass] from the
+            [-1, numSubinstance, numTimeSteps, numClass] softmax).
+
+        returns an array (or memory map) of len(X) results. Raises
+            ValueError if X is empty.
+        '''
+        if len(X) == 0:
+            raise ValueError('runInference needs at least one data point')
+        sess = self.__sess
+        if feedDict is None:
+            feedDict = self.feedDictFunc(**kwargs)
+        self._dataPipe.runInitializer(sess, X, Y, batchSize,
+                                       numEpochs=1)
+        out = None
+        start = 0
+        while True:
+            try:
+                res = sess.run(op, feed_dict=feedDict)
+            except tf.errors.OutOfRangeError:
+                break
+            if lastStepOnly:
+                res = res[..., -1, :]
+            if out is None:
+                shape = (len(X),) + res.shape[1:]
+                if outFile is not None:
+                    out = np.lib.format.open_memmap(outFile, mode='w+',
+                                                    dtype=res.dtype,
+                                                    shape=shape)
+                else:
+                    out = np.empty(shape, dtype=res.dtype)
+            out[start:start + len(res)] = res
+            start += len(res)
+        assert start == len(X), 'Internal error!'
+        if outFile is not None:
+            out.flush()
+        return out
+
     def run(self, numClasses, x_train, y_train, bag_train, x_val, y_val,
             bag_val, numIter, numRounds, batchSize, numEpochs, echoCB=None,
             redirFile=None, modelPrefix='/tmp/model', updatePolicy='top-k',
@@ -431,6 +486,8 @@ class EMI_Driver:
         batchSize: Batch Size.
         numEpochs: Number of epochs per iteration. A model checkpoint is
             created after evey numEpochs passes over the data.
+            The training data is shuffled every epoch by the data
+            pipeline (see shuffleBufferSize and seed of EMI_DataPipeline).
         feedDict: Feed dict for training procedure (optional).
         echoCB: The echo function (print function) that is passed to the
             EMI_Trainer.trian() method. Defaults to self.fancyEcho()
@@ -442,6 +499,21 @@ class EMI_Driver:
             initial (1-fracEMI) rounds will use regular MI-RNN loss. To perform
             only MI-RNN training, set this to 0.0.
         lossIndicator: NotImplemented
+        reloadGraph: (keyword only, default True) If True, the best model of
+            each round is loaded by importing its meta graph into a new graph
+            and session (see loadSavedGraphToNewSession). If False, only the
+            variable values of the best model are restored and the current
+            graph and session are reused across rounds (see
+            loadSavedVariables).
+        keepBestInMemory: (keyword only, default False) If True, no
+            checkpoint is written after each iteration. Instead, the
+            variable values of the best iteration of the round are kept in
+            memory and restored at the end of the round, and only this
+            round winner is checkpointed to modelPrefix on a background
+            thread. The current graph and session are reused (reloadGraph
+            is ignored). Since the Saver keeps the last
+            max_to_keep checkpoints, max_to_keep then acts as the number of
+            most recent round winners kept on disk.
         *args, **kwargs: Additional arguments passed to callback methods and
             update policy methods.
 
@@ -450,6 +522,12 @@ class EMI_Driver:
         '''
         assert self.__sess is not None, 'No sessions initialized'
         sess = self.__sess
+        # Keyword only, so that extra positional arguments still end up in
+        # *args
+        reloadGraph = kwargs.pop('reloadGraph', True)
+        keepBestInMemory = kwargs.pop('keepBestInMemory', False)
+        # The best model of a round is picked among its iterations
+        assert numIter >= 1, 'numIter should be >= 1'
         assert updatePolicy in ['prune-ends', 'top-k']
         if updatePolicy == 'top-k':
             print("Update policy: top-k", file=redirFile)
@@ -466,7 +544,12 @@ class EMI_Driver:
         print("Training with MI-RNN loss for %d rounds" % emiStep,
               file=redirFile)
         modelStats = []
+        saveThread = None
         for cround in range(numRounds):
+            # The previous round winner should be on disk before any variable
+            # is modified
+            if saveThread is not None:
+                saveThread.join()
             feedDict = self.feedDictFunc(inference=False, **kwargs)
             print("Round: %d" % cround, file=redirFile)
             if cround == emiStep:
@@ -481,10 +564,12 @@ class EMI_Driver:
                          feed_dict={self._emiTrainer.lossIndicatorPlaceholder:
                                     lossIndicator})
             valAccList, globalStepList = [], []
+            bestValues = None
             # Train the best model for the current round
             for citer in range(numIter):
                 self._dataPipe.runInitializer(sess, x_train, curr_y,
-                                               batchSize, numEpochs)
+                                               batchSize, numEpochs,
+                                               shuffle=True)
                 numBatches = int(np.ceil(len(x_train) / batchSize))
                 self._emiTrainer.trainModel(sess, echoCB=self.fancyEcho,
                                              numBatches=numBatches,
@@ -494,6 +579,13 @@ class EMI_Driver:
                                   x_val, y_val, batchSize, inference=True)
                 acc = np.mean(np.reshape(np.array(acc), -1))
                 print(" Val acc %2.5f | " % acc, end='', file=redirFile)
+                if keepBestInMemory:
+                    # argmax picks the first best iteration
+                    if len(valAccList) == 0 or acc > np.max(valAccList):
+                        bestValues = self.__getVariableValues(sess)
+                    print("", file=redirFile)
+                    valAccList.append(acc)
+                    continue
                 self.__graphManager.checkpointModel(self.__saver, sess,
                                                     modelPrefix,
                                                     self.__globalStep,
@@ -504,22 +596,55 @@ class EMI_Driver:
 
             # Update y for the current round
             ## Load the best val-acc model
-            argAcc = np.argmax(valAccList)
-            resPrefix, resStep = globalStepList[argAcc]
+            if keepBestInMemory:
+                self.__setVariableValues(sess, bestValues)
+                resPrefix, resStep = modelPrefix, self.__globalStep
+                self.__globalStep += 1
+                # Nothing modifies the variables till the next round starts
+                # training, so the checkpoint is written in the background
+                # while the labels are updated.
+                saveThread = threading.Thread(
+                    target=self.__graphManager.checkpointModel,
+                    args=(self.__saver, sess, resPrefix, resStep),
+                    kwargs={'redirFile': redirFile})
+                saveThread.start()
+            else:
+                argAcc = np.argmax(valAccList)
+                resPrefix, resStep = globalStepList[argAcc]
             modelStats.append((cround, np.max(valAccList),
                                resPrefix, resStep))
-            self.loadSavedGraphToNewSession(resPrefix, resStep, redirFile)
-            sess = self.getCurrentSession()
+            if keepBestInMemory:
+                # Best values have already been restored
+                pass
+            elif reloadGraph:
+                self.loadSavedGraphToNewSession(resPrefix, resStep, redirFile)
+                sess = self.getCurrentSession()
+            else:
+                self.loadSavedVariables(resPrefix, resStep, redirFile)
             feedDict = self.feedDictFunc(inference=True, **kwargs)
-            smxOut = self.runOps([self._emiTrainer.softmaxPredictions],
-                                     x_train, y_train, batchSize, feedDict)
-            smxOut= [np.array(smxOut[i][0]) for i in range(len(smxOut))]
-            smxOut = np.concatenate(smxOut)[:, :, -1, :]
+            smxOut = self.runInference(self._emiTrainer.softmaxPredictions,
+                                       x_train, y_train, batchSize, feedDict,
+                                       lastStepOnly=True)
             newY = updatePolicyFunc(curr_y, smxOut, bag_train,
                                     numClasses, **kwargs)
             currY = newY
+        if saveThread is not None:
+            saveThread.join()
         return currY, modelStats
 
+    def __getVariableValues(self, sess):
+        varList = sess.graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)
+        return list(zip(varList, sess.run(varList)))
+
+    def __setVariableValues(self, sess, values):
+        '''
+        Loads the values returned by __getVariableValues. Variable.load feeds
+        the value to the initializer of the variable, so no new assign ops
+        are added to the graph.
+        '''
+        for var, value in values:
+            var.load(value, sess)
+
     def loadSavedGraphToNewSession(self, modelPrefix, globalStep,
                                       redirFile=None):
         self.__sess.close()
@@ -535,6 +660,17 @@ class EMI_Driver:
         self.__sess = sess
         return graph
 
+    def loadSavedVariables(self, modelPrefix, globalStep, redirFile=None):
+        '''
+        Restores the variable values saved at modelPrefix-globalStep into the
+        current session. The current graph is reused so the checkpoint must
+        have been created from this graph (for instance, by run()).
+        '''
+        assert self.__sess is not None, 'No sessions initialized'
+        self.__graphManager.restoreVariables(self.__saver, self.__sess,
+                                             modelPrefix, globalStep,
+                                             redirFile=redirFile)
+
     def updateLabel(self, Y, policy, softmaxOut, bagLabel, numClasses, **kwargs):
         '''
         Updates the current label information based on policy and the predicted
@@ -578,60 +714,32 @@ class EMI_Driver:
         assert (predictions.shape[1] == numSubinstance)
         assert (Y_bag.ndim == 1)
         assert (len(Y_bag) == len(predictions))
-        pholder = [0.0] * numSubinstance
+        # Longest run lengths are computed only once. The bag prediction for
+        # every subsequence length is then derived from them.
+        length, labels = self.__getBagRunLengths(predictions, numClass)
+        cmatrix = self.__getSubsequenceConfusionMatrices(length, labels,
+                                                         Y_bag,
+                                                         numSubinstance,
+                                                         numClass)
+        # cmatrix[i-1] is the confusion matrix for minSubsequenceLen = i
+        trueAcc = np.trace(cmatrix, axis1=1, axis2=2) / float(len(Y_bag))
         df = pd.DataFrame()
         df['len'] = np.arange(1, numSubinstance + 1)
-        df['acc'] = pholder
-        df['macro-fsc'] = pholder
-        df['macro-pre'] = pholder
-        df['macro-rec'] = pholder
-
-        df['micro-fsc'] = pholder
-        df['micro-pre'] = pholder
-        df['micro-rec'] = pholder
-        colList = []
-        colList.append('acc')
-        colList.append('macro-fsc')
-        colList.append('macro-pre')
-        colList.append('macro-rec')
-
-        colList.append('micro-fsc')
-        colList.append('micro-pre')
-        colList.append('micro-rec')
-        for i in range(0, numClass):
-            pre = 'pre_%02d' % i
-            rec = 'rec_%02d' % i
-            df[pre] = pholder
-            df[rec] = pholder
-            colList.append(pre)
-            colList.append(rec)
-
-        for i in range(1, numSubinstance + 1):
-            pred_ = self.getBagPredictions(predictions, numClass=numClass,
-                                           minSubsequenceLen=i,
-                                           redirFile = redirFile)
-            correct = (pred_ == Y_bag).astype('int')
-            trueAcc = np.mean(correct)
-            cmatrix = utils.getConfusionMatrix(pred_, Y_bag, numClass)
-            df.iloc[i-1, df.columns.get_loc('acc')] = trueAcc
-
-            macro, micro = utils.getMacroMicroFScore(cmatrix)
-            df.iloc[i-1, df.columns.get_loc('macro-fsc')] = macro
-            df.iloc[i-1, df.columns.get_loc('micro-fsc')] = micro
-
-            pre, rec = utils.getMacroPrecisionRecall(cmatrix)
-            df.iloc[i-1, df.columns.get_loc('macro-pre')] = pre
-            df.iloc[i-1, df.columns.get_loc('macro-rec')] = rec
-
-            pre, rec = utils.getMicroPrecisionRecall(cmatrix)
-            df.iloc[i-1, df.columns.get_loc('micro-pre')] = pre
-            df.iloc[i-1, df.columns.get_loc('micro-rec')] = rec
-            for j in range(numClass):
-                pre, rec = utils.getPrecisionRecall(cmatrix, label=j)
-                pre_ = df.columns.get_loc('pre_%02d' % j)
-                rec_ = df.columns.get_loc('rec_%02d' % j)
-                df.iloc[i-1, pre_ ] = pre
-                df.iloc[i-1, rec_ ] = rec
+        df['acc'] = trueAcc
+        macro, micro = utils.getMacroMicroFScore(cmatrix)
+        df['macro-fsc'] = macro
+        pre, rec = utils.getMacroPrecisionRecall(cmatrix)
+        df['macro-pre'] = pre
+        df['macro-rec'] = rec
+
+        df['micro-fsc'] = micro
+        pre, rec = utils.getMicroPrecisionRecall(cmatrix)
+        df['micro-pre'] = pre
+        df['micro-rec'] = rec
+        for j in range(numClass):
+            pre, rec = utils.getPrecisionRecall(cmatrix, label=j)
+            df['pre_%02d' % j] = pre
+            df['rec_%02d' % j] = rec
 
         df.set_index('len')
         # Comment this line to include all columns
@@ -697,7 +805,8 @@ class EMI_Driver:
         return df
 
     def getInstancePredictions(self, x, y, earlyPolicy, batchSize=1024,
-                               feedDict=None, **kwargs):
+                               feedDict=None, batchedPolicy=False,
+                               outFile=None, **kwargs):
 
         '''
         Returns instance level predictions for data (x, y).
@@ -713,6 +822,17 @@ class EMI_Driver:
                 ...
                 return predictedClass, predictedStep
 
+        batchedPolicy: If True, earlyPolicy is called only once with the
+            softmax outputs of all the instances and should return arrays,
+            def earlyPolicy(instancePredictions):
+                instancePredictions: [-1, numTimeSteps, numClass]
+                ...
+                return predictedClass [-1], predictedStep [-1]
+            utils.earlyPolicyMinProb is a batched policy of this form.
+        outFile: If provided, the softmax outputs are written to this .npy
+            file (memory mapped) instead of being held in memory. See
+            runInference.
+
         returns: predictions, predictionStep
             predictions: [-1, numSubinstance]
             predictionStep: [-1, numSubinstance]
@@ -720,13 +840,21 @@ class EMI_Driver:
         opList = self._emiTrainer.softmaxPredictions
         if 'keep_prob' in kwargs:
             assert kwargs['keep_prob'] == 1, 'Keep prob should be 1.0'
-        smxOut = self.runOps(opList, x, y, batchSize, feedDict=feedDict,
-                             **kwargs)
-        softmaxOut = np.concatenate(smxOut, axis=0)
+        softmaxOut = self.runInference(opList, x, y, batchSize,
+                                       feedDict=feedDict, outFile=outFile,
+                                       **kwargs)
         assert softmaxOut.ndim == 4
         numSubinstance, numTimeSteps, numClass = softmaxOut.shape[1:]
         softmaxOutFlat = np.reshape(softmaxOut, [-1, numTimeSteps, numClass])
         flatLen = len(softmaxOutFlat)
+        if batchedPolicy:
+            predictions, predictionStep = earlyPolicy(softmaxOutFlat,
+                                                      **kwargs)
+            assert len(predictions) == flatLen
+            assert len(predictionStep) == flatLen
+            predictions = np.reshape(predictions, [-1, numSubinstance])
+            predictionStep = np.reshape(predictionStep, [-1, numSubinstance])
+            return predictions, predictionStep
         predictions = np.zeros(flatLen)
         predictionStep = np.zeros(flatLen)
         for i, instance in enumerate(softmaxOutFlat):
@@ -758,43 +886,58 @@ class EMI_Driver:
         [-1, numsubinstance]
         '''
         assert(Y_predicted.ndim == 2)
-        scoreList = []
-        for x in range(1, numClass):
-            scores = self.__getLengthScores(Y_predicted, val=x)
-            length = np.max(scores, axis=1)
-            scoreList.append(length)
-        scoreList = np.array(scoreList)
-        scoreList = scoreList.T
+        length, labels = self.__getBagRunLengths(Y_predicted, numClass)
+        predictionIndex = (length >= minSubsequenceLen)
+        prediction = np.zeros((Y_predicted.shape[0]))
+        prediction[predictionIndex] = labels[predictionIndex]
+        return prediction.astype(int)
+
+    def __getBagRunLengths(self, Y_predicted, numClass):
+        '''
+        Returns the length of the longest run of any non-zero class in each
+        bag and the class of that run (smallest class on ties).
+
+        Y_predicted: [-1, numSubinstance] instance level predictions
+        returns length [-1], labels [-1]
+        '''
+        scores = utils.getLengthScores(Y_predicted, numClass)
+        scoreList = np.max(scores[1:], axis=2).T
         assert(scoreList.ndim == 2)
         assert(scoreList.shape[0] == Y_predicted.shape[0])
         assert(scoreList.shape[1] == numClass - 1)
         length = np.max(scoreList, axis=1)
         assert(length.ndim == 1)
         assert(length.shape[0] == Y_predicted.shape[0])
-        predictionIndex = (length >= minSubsequenceLen)
-        prediction = np.zeros((Y_predicted.shape[0]))
         labels = np.argmax(scoreList, axis=1) + 1
-        prediction[predictionIndex] = labels[predictionIndex]
-        return prediction.astype(int)
+        return length, labels
 
-    def __getLengthScores(self, Y_predicted, val=1):
-        '''
-        Returns an matrix which contains the length of the longest positive
-        subsequence of val ending at that index.
-        Y_predicted: [-1, numSubinstance] Is the instance level class
-            labels.
-        '''
-        scores = np.zeros(Y_predicted.shape)
-        for i, bag in enumerate(Y_predicted):
-            for j, instance in enumerate(bag):
-                prev = 0
-                if j > 0:
-                    prev = scores[i, j-1]
-                if instance == val:
-                    scores[i, j] = prev + 1
-                else:
-                    scores[i, j] = 0
-        return scores
+    def __getSubsequenceConfusionMatrices(self, length, labels, Y_bag,
+                                          numSubinstance, numClass):
+        '''
+        Returns the confusion matrices of the bag predictions for every
+        minSubsequenceLen in [1, numSubinstance] as a
+        [numSubinstance, numClass, numClass] integer array.
+
+        A bag is predicted as labels[i] for all minSubsequenceLen <=
+        length[i] and as class 0 otherwise. Hence the matrix for
+        minSubsequenceLen = l is obtained by moving, from the class 0 row to
+        the labels row, all bags with length >= l. These counts are a reverse
+        cumulative sum over lengths.
+        '''
+        Y_bag = np.asarray(Y_bag).astype(np.int64)
+        length = np.minimum(length, numSubinstance).astype(np.int64)
+        labels = labels.astype(np.int64)
+        index = (length * numClass + labels) * numClass + Y_bag
+        counts = np.bincount(index, minlength=(numSubinstance + 1) *
+                             numClass * numClass)
+        counts = np.reshape(counts, [numSubinstance + 1, numClass, numClass])
+        # atLeast[l] is the count of bags with length >= l
+        atLeast = np.cumsum(counts[::-1], axis=0)[::-1][1:]
+        base = np.zeros([numClass, numClass], dtype=np.int64)
+        base[0] = np.bincount(Y_bag, minlength=numClass)
+        cmatrix = base + atLeast
+        cmatrix[:, 0, :] -= np.sum(atLeast, axis=1)
+        return cmatrix
 
     def __policyPrune(self, currentY, softmaxOut, bagLabel, numClasses,
                       minNegativeProb=0.0, updatesPerCall=3,
@@ -836,68 +979,59 @@ class EMI_Driver:
         assert maxAllowedUpdates < numSubinstance
         assert softmaxOut.shape[1] == numSubinstance
 
-        index = (bagLabel != 0)
-        indexList = np.where(bagLabel)[0]
         newY = np.array(currentY)
-        for i in indexList:
-            currLabel = currentY[i]
-            currProbabilities = softmaxOut[i]
-            prevPrefix = 0
-            prevSuffix = 0
-            for inst in currLabel:
-                if np.argmax(inst) == 0:
-                    prevPrefix += 1
-                else:
-                    break
-            for inst in reversed(currLabel):
-                if np.argmax(inst) == 0:
-                    prevSuffix += 1
-                else:
-                    break
-            assert (prevPrefix + prevSuffix <= maxAllowedUpdates)
-            leftIdx = int(prevPrefix)
-            rightIdx = numSubinstance - int(prevSuffix) - 1
-            possibleUpdates = min(updatesPerCall, maxAllowedUpdates - prevPrefix - prevSuffix)
-            while (possibleUpdates > 0):
-                assert leftIdx < numSubinstance
-                assert leftIdx >= 0
-                assert rightIdx < numSubinstance
-                assert rightIdx >= 0
-                leftLbl = np.argmax(currProbabilities[leftIdx])
-                leftProb = np.max(currProbabilities[leftIdx])
-                rightLbl = np.argmax(currProbabilities[rightIdx])
-                rightProb = np.max(currProbabilities[rightIdx])
-                if (leftLbl != 0 and rightLbl !=0):
-                    break
-                elif (leftLbl == 0 and rightLbl != 0):
-                    if leftProb >= minNegativeProb:
-                        newY[i, leftIdx, :] = 0
-                        newY[i, leftIdx, 0] = 1
-                        leftIdx += 1
-                    else:
-                        break
-                elif (leftLbl != 0 and rightLbl == 0):
-                    if rightProb >= minNegativeProb:
-                        newY[i, rightIdx, :] = 0
-                        newY[i, rightIdx, 0] = 1
-                        rightIdx -= 1
-                    else:
-                        break
-                elif leftProb >= rightProb:
-                    if leftProb >= minNegativeProb:
-                        newY[i, leftIdx, :] = 0
-                        newY[i, leftIdx, 0] = 1
-                        leftIdx += 1
-                    else:
-                        break
-                elif rightProb > leftProb:
-                    if rightProb >= minNegativeProb:
-                        newY[i, rightIdx, :] = 0
-                        newY[i, rightIdx, 0] = 1
-                        rightIdx -= 1
-                    else:
-                        break
-                possibleUpdates -= 1
+        # All positive bags are processed together. Each step of the while
+        # loop of the per bag algorithm is one step over all active bags.
+        indexList = np.where(bagLabel)[0]
+        currProbabilities = softmaxOut[indexList]
+        isNegative = (np.argmax(currentY[indexList], axis=2) == 0)
+        # Length of the leading and trailing runs of negative labels
+        prevPrefix = np.argmin(isNegative, axis=1)
+        prevPrefix[np.all(isNegative, axis=1)] = numSubinstance
+        prevSuffix = np.argmin(isNegative[:, ::-1], axis=1)
+        prevSuffix[np.all(isNegative, axis=1)] = numSubinstance
+        assert np.all(prevPrefix + prevSuffix <= maxAllowedUpdates)
+        leftIdx = prevPrefix
+        rightIdx = numSubinstance - prevSuffix - 1
+        possibleUpdates = np.minimum(updatesPerCall, maxAllowedUpdates -
+                                     prevPrefix - prevSuffix)
+        active = np.ones(len(indexList), dtype=bool)
+        bags = np.arange(len(indexList))
+        for step in range(updatesPerCall):
+            active &= (possibleUpdates > step)
+            if not np.any(active):
+                break
+            assert np.all(leftIdx[active] < numSubinstance)
+            assert np.all(leftIdx[active] >= 0)
+            assert np.all(rightIdx[active] < numSubinstance)
+            assert np.all(rightIdx[active] >= 0)
+            leftProbabilities = currProbabilities[bags, leftIdx]
+            rightProbabilities = currProbabilities[bags, rightIdx]
+            leftNeg = (np.argmax(leftProbabilities, axis=1) == 0)
+            leftProb = np.max(leftProbabilities, axis=1)
+            rightNeg = (np.argmax(rightProbabilities, axis=1) == 0)
+            rightProb = np.max(rightProbabilities, axis=1)
+            # Ties go to the left. Comparisons with nan select neither side
+            # and leave the bag unchanged for this step.
+            bothNeg = leftNeg & rightNeg
+            chooseLeft = (leftNeg & ~rightNeg)
+            chooseLeft |= bothNeg & (leftProb >= rightProb)
+            chooseRight = (~leftNeg & rightNeg)
+            chooseRight |= bothNeg & (rightProb > leftProb)
+            chosenProb = np.where(chooseLeft, leftProb, rightProb)
+            accepted = (chosenProb >= minNegativeProb)
+            updateLeft = active & chooseLeft & accepted
+            updateRight = active & chooseRight & accepted
+            stop = ~(leftNeg | rightNeg)
+            stop |= (chooseLeft | chooseRight) & ~accepted
+            updates = [(updateLeft, leftIdx), (updateRight, rightIdx)]
+            for update, idx in updates:
+                bagIdx = indexList[update]
+                newY[bagIdx, idx[update], :] = 0
+                newY[bagIdx, idx[update], 0] = 1
+            leftIdx = leftIdx + updateLeft
+            rightIdx = rightIdx - updateRight
+            active &= ~stop
         return newY
 
     def __policyTopK(self, currentY, softmaxOut, bagLabel, numClasses, k=1,
@@ -921,17 +1055,10 @@ class EMI_Driver:
         assert k > 0
         # predicted label for each instance is max of softmax
         predictedLabels = np.argmax(softmaxOut, axis=2)
-        scoreList = []
         # classScores[i] is a 2d array where a[j,k] is the longest
         # string of consecutive class labels i in bag j ending at instance k
-        classScores = [-1]
-        for i in range(1, numClasses):
-            scores = self.__getLengthScores(predictedLabels, val=i)
-            classScores.append(scores)
-            length = np.max(scores, axis=1)
-            scoreList.append(length)
-        scoreList = np.array(scoreList)
-        scoreList = scoreList.T
+        classScores = utils.getLengthScores(predictedLabels, numClasses)
+        scoreList = np.max(classScores[1:], axis=2).T
         # longestContinuousClass[i] is the class label having
         # longest substring in bag i
         longestContinuousClass = np.argmax(scoreList, axis=1) + 1
@@ -943,42 +1070,51 @@ class EMI_Driver:
         assert longestContinuousClassLength.ndim == 1
         assert longestContinuousClassLength.shape[0] == bagLabel.shape[0]
         newY = np.array(currentY)
+        # Only non-zero bags whose longest continuous class is the bag label
+        # and is at least k long are updated
         index = (bagLabel != 0)
+        index &= (longestContinuousClass == bagLabel)
+        index &= (longestContinuousClassLength >= k)
         indexList = np.where(index)[0]
-        # iterate through all non-zero bags
-        for i in indexList:
-            # longest continuous class for this bag
-            lcc = longestContinuousClass[i]
-            # length of longest continuous class for this bag
-            lccl = int(longestContinuousClassLength[i])
-            # if bagLabel is not the same as longest continuous
-            # class, don't update
-            if lcc != bagLabel[i]:
-                continue
-            # we check for longest string to be at least k
-            if lccl < k:
-                continue
-            lengths = classScores[lcc][i]
-            assert np.max(lengths) == lccl
-            possibleCandidates = np.where(lengths == lccl)[0]
-            # stores (candidateIndex, sum of probabilities
-            # over window for this index) pairs
-            sumProbsAcrossLongest = {}
-            for candidate in possibleCandidates:
-                sumProbsAcrossLongest[candidate] = 0.0
-                # sum the probabilities over the continuous substring
-                for j in range(0, lccl):
-                    sumProbsAcrossLongest[candidate] += softmaxOut[i, candidate-j, lcc]
-            # we want only the one with maximum sum of
-            # probabilities; sort dict by value
-            sortedProbs = sorted(sumProbsAcrossLongest.items(),key=lambda x: x[1], reverse=True)
-            bestCandidate = sortedProbs[0][0]
-            # apart from (bestCanditate-lcc,bestCandidate] label
-            # everything else as 0
-            newY[i, :, :] = 0
-            newY[i, :, 0] = 1
-            newY[i, bestCandidate-lccl+1:bestCandidate+1, 0] = 0
-            newY[i, bestCandidate-lccl+1:bestCandidate+1, lcc] = 1
+        if len(indexList) == 0:
+            return newY
+        # longest continuous class and its length for the updated bags
+        lcc = longestContinuousClass[indexList]
+        lccl = longestContinuousClassLength[indexList].astype(int)
+        lengths = classScores[lcc, indexList]
+        assert np.all(np.max(lengths, axis=1) == lccl)
+        # Candidates are the end points of the longest substrings of lcc
+        possibleCandidates = (lengths == lccl[:, np.newaxis])
+        # Sum of the probabilities of lcc over the window ending at each
+        # position. The window sums are accumulated one offset at a time
+        # (in float64, same order as a sequential sum) so that candidates
+        # with equal sums are resolved exactly as before.
+        probabilities = softmaxOut[indexList[:, np.newaxis],
+                                   np.arange(currentY.shape[1]),
+                                   lcc[:, np.newaxis]]
+        sumProbsAcrossLongest = np.zeros(probabilities.shape)
+        for j in range(np.max(lccl)):
+            shifted = np.zeros(probabilities.shape)
+            shifted[:, j:] = probabilities[:, :probabilities.shape[1] - j]
+            shifted[j >= lccl] = 0.0
+            sumProbsAcrossLongest += shifted
+        # we want only the one with maximum sum of probabilities; argmax
+        # returns the first (left most) candidate on ties. nan sums are
+        # never preferred.
+        notCandidate = ~possibleCandidates | np.isnan(sumProbsAcrossLongest)
+        sumProbsAcrossLongest[notCandidate] = -np.inf
+        bestCandidate = np.argmax(sumProbsAcrossLongest, axis=1)
+        # apart from (bestCanditate-lcc,bestCandidate] label
+        # everything else as 0
+        position = np.arange(currentY.shape[1])
+        window = (position <= bestCandidate[:, np.newaxis])
+        window &= (position > (bestCandidate - lccl)[:, np.newaxis])
+        updatedY = np.zeros((len(indexList),) + currentY.shape[1:],
+                            dtype=newY.dtype)
+        updatedY[:, :, 0] = ~window
+        windowBag, windowPos = np.where(window)
+        updatedY[windowBag, windowPos, lcc[windowBag]] = 1
+        newY[indexList] = updatedY
         return newY
 
     def feedDictFunc(self, **kwargs):
@@ -12,7 +12,7 @@ import sys
 class FastTrainer:
 
     def __init__(self, FastObj, X, Y, sW=1.0, sU=1.0, learningRate=0.01,
-                 outFile=None):
+                 outFile=None, inGraphIHT=False):
         '''
         FastObj - Can be either FastRNN or FastGRNN with proper initialisations
         sW and sU are the sparsity factors for Fast parameters
@@ -20,6 +20,9 @@ class FastTrainer:
         Y is the label placeholder for loss computation - Dims [_, num_classes]
         batchSize is the batchSize
         learningRate is the initial learning rate
+        inGraphIHT - If True, hard thresholding and sparse retraining run as
+        graph ops (utils.getHardThresholdOps) without moving the parameters
+        to the host
         '''
 
         self.FastObj = FastObj
@@ -64,6 +67,21 @@ class FastTrainer:
         self.hardThrsdGraph()
         self.sparseTrainingGraph()
 
+        # Thresholds of the previous IHT step are reused as warm starts
+        self.thresholders = []
+        for i in range(0, self.numMatrices[0]):
+            self.thresholders.append(utils.HardThresholder(self.sW))
+        for i in range(self.numMatrices[0], self.totalMatrices):
+            self.thresholders.append(utils.HardThresholder(self.sU))
+
+        self.inGraphIHT = inGraphIHT
+        if self.inGraphIHT is True:
+            sparsityList = [self.sW] * self.numMatrices[0]
+            sparsityList += [self.sU] * self.numMatrices[1]
+            self.ihtOp, self.sparseRetrainOp = utils.getHardThresholdOps(
+                self.FastParams[:self.totalMatrices], sparsityList,
+                name='fast-hard-threshold')
+
     def RNN(self, x, timeSteps, FastObj):
         '''
         Unrolls and adds linear classifier
@@ -165,13 +183,19 @@ class FastTrainer:
         '''
         Function to run the IHT routine on FastObj
         '''
+        if self.inGraphIHT is True:
+            sess.run(self.ihtOp)
+            return
+
         self.thrsdParams = []
-        for i in range(0, self.numMatrices[0]):
-            self.thrsdParams.append(
-                utils.hardThreshold(self.FastParams[i].eval(), self.sW))
-        for i in range(self.numMatrices[0], self.totalMatrices):
-            self.thrsdParams.append(
-                utils.hardThreshold(self.FastParams[i].eval(), self.sU))
+        for i in range(0, self.totalMatrices):
+            self.thrsdParams.append(self.thresholders[i](
+                self.FastParams[i].eval(), inplace=True))
+
+        # Supports are kept for the sparse retraining steps
+        self.supportMasks = []
+        for i in range(0, self.totalMatrices):
+            self.supportMasks.append(utils.SupportMask(self.thrsdParams[i]))
 
         fd_thrsd = {}
         for i in range(0, self.totalMatrices):
@@ -182,10 +206,14 @@ class FastTrainer:
         '''
         Function to run the Sparse Retraining routine on FastObj
         '''
+        if self.inGraphIHT is True:
+            sess.run(self.sparseRetrainOp)
+            return
+
         self.reTrainParams = []
         for i in range(0, self.totalMatrices):
-            self.reTrainParams.append(
-                utils.copySupport(self.thrsdParams[i], self.FastParams[i].eval()))
+            self.reTrainParams.append(self.supportMasks[i](
+                self.FastParams[i].eval(), inplace=True))
 
         fd_st = {}
         for i in range(0, self.totalMatrices):
@@ -267,6 +295,25 @@ class FastTrainer:
         np.save(currDir + '/FC.npy', self.FC.eval())
         np.save(currDir + '/FCbias.npy', self.FCbias.eval())
 
+    def __runTest(self, sess, Xtest, Ytest, batchSize):
+        '''
+        Returns accuracy and loss on the test set, evaluated in chunks of
+        batchSize rows. Accuracy and loss are batch means, so they are
+        accumulated weighted by the chunk sizes.
+        '''
+        testAcc, testLoss = 0.0, 0.0
+        numRows = Xtest.shape[0]
+        for start in range(0, numRows, batchSize):
+            batchX = Xtest[start:start + batchSize]
+            batchY = Ytest[start:start + batchSize]
+            batchX = batchX.reshape((-1, self.timeSteps, self.inputDims))
+            batchAcc, batchLoss = sess.run([self.accuracy, self.lossOp],
+                                           feed_dict={self.X: batchX,
+                                                      self.Y: batchY})
+            testAcc += batchAcc * len(batchY)
+            testLoss += batchLoss * len(batchY)
+        return testAcc / numRows, testLoss / numRows
+
     def train(self, batchSize, totalEpochs, sess,
               Xtrain, Xtest, Ytrain, Ytest,
               decayStep, decayRate, dataDir, currDir):
@@ -287,8 +334,8 @@ class FastTrainer:
             maxTestAcc = -10000
         header = '*' * 20
 
-        Xtest = Xtest.reshape((-1, self.timeSteps, self.inputDims))
-        Xtrain = Xtrain.reshape((-1, self.timeSteps, self.inputDims))
+        # Xtrain and Xtest can be lazily loaded (edgeml.datasets.NpyDataset),
+        # so they are reshaped batch by batch
 
         for i in range(0, totalEpochs):
             print("\nEpoch Number: " + str(i), file=self.outFile)
@@ -313,6 +360,7 @@ class FastTrainer:
                 else:
                     batchX = Xtrain[j * batchSize:(j + 1) * batchSize]
                     batchY = Ytrain[j * batchSize:(j + 1) * batchSize]
+                batchX = batchX.reshape((-1, self.timeSteps, self.inputDims))
 
                 # Mini-batch training
                 _, batchLoss, batchAcc = sess.run([self.trainOp, self.lossOp, self.accuracy], feed_dict={
@@ -349,8 +397,7 @@ class FastTrainer:
                   " Train Accuracy: " + str(trainAcc / numIters),
                   file=self.outFile)
 
-            testAcc, testLoss = sess.run([self.accuracy, self.lossOp], feed_dict={
-                                         self.X: Xtest, self.Y: Ytest})
+            testAcc, testLoss = self.__runTest(sess, Xtest, Ytest, batchSize)
 
             if ihtDone == 0:
                 maxTestAcc = -10000
@@ -11,7 +11,8 @@ import edgeml.utils as utils
 class ProtoNNTrainer:
     def __init__(self, protoNNObj, regW, regB, regZ,
                  sparcityW, sparcityB, sparcityZ,
-                 learningRate, X, Y, lossType='l2'):
+                 learningRate, X, Y, lossType='l2', inGraphIHT=False,
+                 normExpansion=None):
         '''
         A wrapper for the various techniques used for training ProtoNN. This
         subsumes both the responsibility of loss graph construction and
@@ -33,7 +34,16 @@ class ProtoNNTrainer:
         X, Y : Placeholders for data and labels.
             X [-1, featureDimension]
             Y [-1, num Labels]
+            X can be a tf.sparse_placeholder, in which case the train and
+            validation data are expected as scipy.sparse matrices (CSR).
         lossType: ['l2', 'xentropy']
+        inGraphIHT: If True, hard thresholding runs as a graph op
+            (utils.getHardThresholdOps) without moving W, B and Z to the
+            host.
+        normExpansion: If True, the forward graph of protoNNObj computes the
+            prototype distances as ||WX||^2 - 2 WX.B + ||B||^2 with matmuls
+            instead of a [-1, d_cap, m] broadcast (see ProtoNN). None keeps
+            the setting of protoNNObj.
         '''
         self.protoNNObj = protoNNObj
         self.__regW = regW
@@ -45,6 +55,7 @@ class ProtoNNTrainer:
         self.__lR = learningRate
         self.X = X
         self.Y = Y
+        self.isSparseInput = isinstance(X, tf.SparseTensor)
         self.sparseTraining = True
         if (sparcityW == 1.0) and (sparcityB == 1.0) and (sparcityZ == 1.0):
             self.sparseTraining = False
@@ -54,9 +65,14 @@ class ProtoNNTrainer:
         self.B_th = None
         self.Z_th = None
         self.__lossType = lossType
+        self.__inGraphIHT = inGraphIHT
+        # Thresholds of the previous IHT step are reused as warm starts
+        self.__thresholderW = utils.HardThresholder(sparcityW)
+        self.__thresholderB = utils.HardThresholder(sparcityB)
+        self.__thresholderZ = utils.HardThresholder(sparcityZ)
         self.__validInit = False
         self.__validInit = self.__validateInit()
-        self.__protoNNOut = protoNNObj(X, Y)
+        self.__protoNNOut = protoNNObj(X, Y, normExpansion=normExpansion)
         self.loss = self.__lossGraph()
         self.trainStep = self.__trainGraph()
         self.__hthOp = self.__getHardThresholdOp()
@@ -76,8 +92,14 @@ class ProtoNNTrainer:
         assert (self.Y.shape[1] == L), msg
         msg = 'X should be of dimension [-1, featureDimension]'
         msg += ' specified as part of ProtoNN object.'
-        assert (len(self.X.shape) == 2), msg
-        assert (self.X.shape[1] == d), msg
+        if self.isSparseInput:
+            # Dimensions of sparse placeholders are not always known
+            assert self.X.shape.ndims in [None, 2], msg
+            if self.X.shape.ndims == 2 and self.X.shape[1].value is not None:
+                assert (self.X.shape[1].value == d), msg
+        else:
+            assert (len(self.X.shape) == 2), msg
+            assert (self.X.shape[1] == d), msg
         self.__validInit = True
         msg = 'Values can be \'l2\', or \'xentropy\''
         if self.__lossType not in ['l2', 'xentropy']:
@@ -115,6 +137,11 @@ class ProtoNNTrainer:
         self.W_th = tf.placeholder(tf.float32, name='W_th')
         self.B_th = tf.placeholder(tf.float32, name='B_th')
         self.Z_th = tf.placeholder(tf.float32, name='Z_th')
+        if self.__inGraphIHT:
+            hard_thrsd_op, _ = utils.getHardThresholdOps(
+                [W, B, Z], [self.__sW, self.__sB, self.__sZ],
+                name='hard-threshold-assignments')
+            return hard_thrsd_op
         with tf.name_scope('hard-threshold-assignments'):
             hard_thrsd_W = W.assign(self.W_th)
             hard_thrsd_B = B.assign(self.B_th)
@@ -122,6 +149,22 @@ class ProtoNNTrainer:
             hard_thrsd_op = tf.group(hard_thrsd_W, hard_thrsd_B, hard_thrsd_Z)
         return hard_thrsd_op
 
+    def __getFeedValue(self, x):
+        if self.isSparseInput:
+            return utils.getSparseTensorValue(x)
+        return x
+
+    def __getBatchBounds(self, numRows, numBatches):
+        '''
+        Returns the row bounds of the same split as np.array_split along the
+        first axis. Batches are sliced as A[bounds[i]:bounds[i + 1]] when
+        they are used, which also works for scipy.sparse matrices and
+        memory mapped data sets without loading all the batches at once.
+        '''
+        sizes = [numRows // numBatches + 1] * (numRows % numBatches)
+        sizes += [numRows // numBatches] * (numBatches - numRows % numBatches)
+        return np.cumsum([0] + sizes)
+
     def train(self, batchSize, totalEpochs, sess,
               x_train, x_val, y_train, y_val, noInit=False,
               redirFile=None, printStep=10, valStep=3):
@@ -137,6 +180,8 @@ class ProtoNNTrainer:
         x_train, x_val, y_train, y_val: The numpy array containing train and
             validation data. x data is assumed to in of shape [-1,
             featureDimension] while y should have shape [-1, numberLabels].
+            When X is a sparse placeholder, x_train and x_val should be
+            scipy.sparse CSR matrices.
         noInit: By default, all the tensors of the computation graph are
         initialized at the start of the training session. Set noInit=False to
         disable this behaviour.
@@ -159,20 +204,19 @@ class ProtoNNTrainer:
         if sess is None:
             raise ValueError('sess must be valid Tensorflow session.')
 
-        trainNumBatches = int(np.ceil(len(x_train) / batchSize))
-        valNumBatches = int(np.ceil(len(x_val) / batchSize))
-        x_train_batches = np.array_split(x_train, trainNumBatches)
-        y_train_batches = np.array_split(y_train, trainNumBatches)
-        x_val_batches = np.array_split(x_val, valNumBatches)
-        y_val_batches = np.array_split(y_val, valNumBatches)
+        trainNumBatches = int(np.ceil(x_train.shape[0] / batchSize))
+        valNumBatches = int(np.ceil(x_val.shape[0] / batchSize))
+        trainBounds = self.__getBatchBounds(x_train.shape[0], trainNumBatches)
+        valBounds = self.__getBatchBounds(x_val.shape[0], valNumBatches)
         if not noInit:
             sess.run(tf.global_variables_initializer())
         X, Y = self.X, self.Y
         W, B, Z, _ = self.protoNNObj.getModelMatrices()
         for epoch in range(totalEpochs):
-            for i in range(len(x_train_batches)):
-                batch_x = x_train_batches[i]
-                batch_y = y_train_batches[i]
+            for i in range(trainNumBatches):
+                start, end = trainBounds[i], trainBounds[i + 1]
+                batch_x = self.__getFeedValue(x_train[start:end])
+                batch_y = y_train[start:end]
                 feed_dict = {
                     X: batch_x,
                     Y: batch_y
@@ -186,21 +230,24 @@ class ProtoNNTrainer:
                     print(msg, file=redirFile)
 
             # Perform Hard thresholding
-            if self.sparseTraining:
+            if self.sparseTraining and self.__inGraphIHT:
+                sess.run(self.__hthOp)
+            elif self.sparseTraining:
                 W_, B_, Z_ = sess.run([W, B, Z])
                 fd_thrsd = {
-                    self.W_th: utils.hardThreshold(W_, self.__sW),
-                    self.B_th: utils.hardThreshold(B_, self.__sB),
-                    self.Z_th: utils.hardThreshold(Z_, self.__sZ)
+                    self.W_th: self.__thresholderW(W_, inplace=True),
+                    self.B_th: self.__thresholderB(B_, inplace=True),
+                    self.Z_th: self.__thresholderZ(Z_, inplace=True)
                 }
                 sess.run(self.__hthOp, feed_dict=fd_thrsd)
 
             if (epoch + 1) % valStep  == 0:
                 acc = 0.0
                 loss = 0.0
-                for j in range(len(x_val_batches)):
-                    batch_x = x_val_batches[j]
-                    batch_y = y_val_batches[j]
+                for j in range(valNumBatches):
+                    start, end = valBounds[j], valBounds[j + 1]
+                    batch_x = self.__getFeedValue(x_val[start:end])
+                    batch_y = y_val[start:end]
                     feed_dict = {
                         X: batch_x,
                         Y: batch_y
@@ -209,7 +256,7 @@ class ProtoNNTrainer:
                                            feed_dict=feed_dict)
                     acc += acc_
                     loss += loss_
-                acc /= len(y_val_batches)
-                loss /= len(y_val_batches)
+                acc /= valNumBatches
+                loss /= valNumBatches
                 print("Test Loss: %2.5f Accuracy: %2.5f" % (loss, acc))
 
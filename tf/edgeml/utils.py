@@ -6,7 +6,13 @@ import tensorflow as tf
 import numpy as np
 import scipy.cluster
 import scipy.spatial
+import scipy.sparse
 import os
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 
 def medianHeuristic(data, projectionDimension, numPrototypes, W_init=None):
@@ -90,19 +96,83 @@ def crossEntropyLoss(logits, label):
                                                    labels=tf.stop_gradient(label)))
 
 
-def hardThreshold(A, s):
+def _getThresholdIndex(numElements, s):
+    '''
+    Index (in ascending order of magnitude) of the 'higher' (1 - s)
+    percentile, as used by np.percentile
+    '''
+    q = ((1 - s) * 100.0) / 100.0
+    return int(np.ceil(q * (numElements - 1)))
+
+
+def _getThreshold(magnitude, s, prevThreshold=None):
+    '''
+    Returns the element of rank _getThresholdIndex in magnitude (a flat
+    array) using selection (np.partition) instead of a full percentile.
+
+    prevThreshold: If given, it is used as a warm start. Elements are
+    counted against it and the selection only runs on the side of
+    prevThreshold that contains the threshold (if at all).
+    '''
+    index = _getThresholdIndex(len(magnitude), s)
+    if prevThreshold is None:
+        return np.partition(magnitude, index)[index]
+    numBelow = np.count_nonzero(magnitude < prevThreshold)
+    if numBelow > index:
+        below = magnitude[magnitude < prevThreshold]
+        return np.partition(below, index)[index]
+    numBelowOrEqual = np.count_nonzero(magnitude <= prevThreshold)
+    if numBelowOrEqual > index:
+        return magnitude.dtype.type(prevThreshold)
+    above = magnitude[magnitude > prevThreshold]
+    index -= numBelowOrEqual
+    return np.partition(above, index)[index]
+
+
+def hardThreshold(A, s, inplace=False):
     '''
     Hard thresholding function on Tensor A with sparsity s
+
+    inplace: If True, A (a numpy array owned by the caller) is thresholded
+        in place and returned. Otherwise a thresholded copy is returned.
     '''
-    A_ = np.copy(A)
-    A_ = A_.ravel()
-    if len(A_) > 0:
-        th = np.percentile(np.abs(A_), (1 - s) * 100.0, interpolation='higher')
-        A_[np.abs(A_) < th] = 0.0
-    A_ = A_.reshape(A.shape)
+    A_ = A if inplace else np.copy(A)
+    if A_.size > 0:
+        magnitude = np.abs(A_)
+        th = _getThreshold(magnitude.ravel(), s)
+        A_[magnitude < th] = 0.0
     return A_
 
 
+class HardThresholder:
+    '''
+    Stateful version of hardThreshold for repeated IHT steps on the same
+    parameter. The threshold of the previous call is used as a warm start
+    for the selection of the new threshold as long as the sparsity s is
+    unchanged. The result is always identical to hardThreshold(A, s).
+    '''
+
+    def __init__(self, s):
+        self.s = s
+        self.threshold = None
+        self.__thresholdSparsity = None
+
+    def __call__(self, A, inplace=False):
+        A_ = A if inplace else np.copy(A)
+        if A_.size == 0:
+            return A_
+        magnitude = np.abs(A_)
+        prevThreshold = None
+        if self.__thresholdSparsity == self.s:
+            prevThreshold = self.threshold
+        th = _getThreshold(magnitude.ravel(), self.s,
+                           prevThreshold=prevThreshold)
+        A_[magnitude < th] = 0.0
+        self.threshold = th
+        self.__thresholdSparsity = self.s
+        return A_
+
+
 def copySupport(src, dest):
     '''
     copy support of src tensor to dest tensor
@@ -114,6 +184,91 @@ def copySupport(src, dest):
     return dest
 
 
+class SupportMask:
+    '''
+    The support (non-zero pattern) of a hard thresholded matrix src. It is
+    computed once and then applied to the retrained values of the matrix at
+    every sparse retraining step, like copySupport(src, dest), but without
+    recomputing the support or allocating a new (float64) matrix.
+    '''
+
+    def __init__(self, src):
+        self.mask = (np.asarray(src) != 0)
+
+    def __call__(self, dest, inplace=True):
+        '''
+        Returns dest with all the entries outside the support set to 0.
+        The dtype of dest is preserved.
+
+        inplace: If True, dest (a numpy array owned by the caller) is
+            modified and returned.
+        '''
+        dest_ = dest if inplace else np.copy(dest)
+        np.multiply(dest_, self.mask, out=dest_)
+        return dest_
+
+
+def getHardThresholdOps(paramList, sparsityList, name='hard-threshold'):
+    '''
+    Creates in-graph equivalents of hardThreshold and copySupport so that
+    IHT does not need to move the parameters to the host.
+
+    paramList: List of tf.Variables to be hard thresholded.
+    sparsityList: Sparsity (fraction of non-zeros to keep) for each variable.
+
+    For every variable a persistent boolean support mask variable is
+    created. The hard threshold op computes the same threshold as
+    hardThreshold (the 'higher' (1 - s) percentile of |A|, obtained with
+    tf.nn.top_k), stores the support (|A| >= threshold and A != 0) in the
+    mask and zeros A outside of it. The sparse retrain op zeros every
+    variable outside of its stored mask, like copySupport.
+
+    returns hardThresholdOp, sparseRetrainOp
+    '''
+    assert len(paramList) == len(sparsityList)
+    hardThresholdList, sparseRetrainList = [], []
+    with tf.name_scope(name):
+        for A, s in zip(paramList, sparsityList):
+            numElements = int(np.prod(A.shape.as_list()))
+            mask = tf.Variable(tf.ones(A.shape, dtype=tf.bool),
+                               trainable=False)
+            zeros = tf.zeros_like(A)
+            if numElements > 0:
+                # index of the 'higher' percentile in ascending order
+                q = ((1 - s) * 100.0) / 100.0
+                index = int(np.ceil(q * (numElements - 1)))
+                flat = tf.reshape(tf.abs(A), [-1])
+                topK, _ = tf.nn.top_k(flat, k=numElements - index)
+                th = topK[-1]
+                support = tf.logical_and(tf.abs(A) >= th,
+                                         tf.not_equal(A, 0.0))
+            else:
+                support = tf.not_equal(A, 0.0)
+            maskAssign = mask.assign(support)
+            hardThresholdList.append(
+                A.assign(tf.where(maskAssign, A, zeros)))
+            sparseRetrainList.append(A.assign(tf.where(mask, A, zeros)))
+        hardThresholdOp = tf.group(*hardThresholdList)
+        sparseRetrainOp = tf.group(*sparseRetrainList)
+    return hardThresholdOp, sparseRetrainOp
+
+
+def getSparseTensorValue(A):
+    '''
+    Converts a scipy.sparse matrix A into a tf.SparseTensorValue that can be
+    fed to a tf.sparse_placeholder. The entries are in the canonical row-major
+    order expected by Tensorflow sparse ops.
+    '''
+    A = scipy.sparse.csr_matrix(A)
+    if not A.has_sorted_indices:
+        A = A.sorted_indices()
+    A = A.tocoo()
+    indices = np.stack([A.row, A.col], axis=1).astype(np.int64)
+    values = A.data.astype(np.float32)
+    denseShape = np.array(A.shape, dtype=np.int64)
+    return tf.SparseTensorValue(indices, values, denseShape)
+
+
 def countnnZ(A, s, bytesPerVar=4):
     '''
     Returns # of non-zeros and representative size of the tensor
@@ -144,14 +299,92 @@ def getConfusionMatrix(predicted, target, numClasses):
     Labels are assumed to be in range(0, numClasses)
     Use`printFormattedConfusionMatrix` to echo the confusion matrix
     in a user friendly form.
+
+    The matrix is computed with a single np.bincount over the flattened
+    (predicted, target) pairs and has an integer (int64) dtype.
     '''
     assert(predicted.ndim == 1)
     assert(target.ndim == 1)
-    arr = np.zeros([numClasses, numClasses])
+    predicted = np.asarray(predicted, dtype=np.int64)
+    target = np.asarray(target, dtype=np.int64)
+    arr = np.bincount(predicted * numClasses + target,
+                      minlength=numClasses * numClasses)
+    return arr.reshape([numClasses, numClasses]).astype(np.int64)
 
-    for i in range(len(predicted)):
-        arr[predicted[i]][target[i]] += 1
-    return arr
+
+class StreamingConfusionMatrix:
+    '''
+    Accumulates a confusion matrix batch by batch, so that metrics over very
+    large evaluation sets can be computed without holding all the predictions
+    in memory. getConfusionMatrix() returns the same matrix (same convention
+    of confusion[predicted][target]) as utils.getConfusionMatrix over the
+    concatenation of all batches seen so far.
+    '''
+
+    def __init__(self, numClasses):
+        self.numClasses = numClasses
+        self.reset()
+
+    def reset(self):
+        self.cmatrix = np.zeros([self.numClasses, self.numClasses],
+                                dtype=np.int64)
+
+    def update(self, predicted, target):
+        '''
+        predicted, target: 1-D integer arrays of the same length for the
+            current batch
+        '''
+        self.cmatrix += getConfusionMatrix(predicted, target, self.numClasses)
+        return self.cmatrix
+
+    def getConfusionMatrix(self):
+        return self.cmatrix
+
+
+def getLengthScores(Y_predicted, numClasses):
+    '''
+    Returns an integer array scores [numClasses, -1, numSubinstance] where
+    scores[c, i, j] is the length of the run of consecutive instances of
+    class c in bag i that ends at instance j (0 if instance j is not c).
+
+    Y_predicted: [-1, numSubinstance] instance level class labels
+
+    Computed for all classes at once: positions where the class does not
+    occur reset the run, and the running maximum of the reset positions
+    gives the start of the current run.
+    '''
+    assert(Y_predicted.ndim == 2)
+    numSubinstance = Y_predicted.shape[1]
+    classes = np.arange(numClasses).reshape([-1, 1, 1])
+    match = (Y_predicted[np.newaxis] == classes)
+    position = np.arange(1, numSubinstance + 1, dtype=np.int32)
+    lastReset = np.where(match, 0, position)
+    np.maximum.accumulate(lastReset, axis=2, out=lastReset)
+    scores = position - lastReset
+    scores[~match] = 0
+    return scores
+
+
+def earlyPolicyMinProb(instanceOut, minProb, **kwargs):
+    '''
+    Batched early prediction policy. An instance is predicted at the first
+    time step where the probability of the predicted class is at least
+    minProb, and at the last time step if there is no such step.
+
+    instanceOut: [-1, numTimeSteps, numClass] softmax outputs
+    returns predictedClass [-1], predictedStep [-1]
+    '''
+    assert instanceOut.ndim == 3
+    numTimeSteps = instanceOut.shape[1]
+    classes = np.argmax(instanceOut, axis=2)
+    prob = np.max(instanceOut, axis=2)
+    confident = (prob >= minProb)
+    # argmax returns the first True. Instances that are never confident are
+    # predicted at the last step
+    predictedStep = np.argmax(confident, axis=1)
+    predictedStep[~np.any(confident, axis=1)] = numTimeSteps - 1
+    predictedClass = classes[np.arange(len(instanceOut)), predictedStep]
+    return predictedClass, predictedStep
 
 
 def printFormattedConfusionMatrix(matrix):
@@ -206,82 +439,193 @@ def printFormattedConfusionMatrix(matrix):
     print('%s|' % (' ' * len(PRECISION)))
 
 
+def _divideOrZero(numer, denom):
+    '''
+    Element-wise numer / denom in float64, with 0 wherever denom is 0
+    '''
+    numer = np.asarray(numer, dtype=np.float64)
+    denom = np.asarray(denom, dtype=np.float64)
+    out = np.zeros(np.broadcast(numer, denom).shape)
+    np.divide(numer, denom, out=out, where=(denom != 0))
+    return out
+
+
 def getPrecisionRecall(cmatrix, label=1):
-    trueP = cmatrix[label][label]
-    denom = np.sum(cmatrix, axis=0)[label]
-    if denom == 0:
-        denom = 1
-    recall = trueP / denom
-    denom = np.sum(cmatrix, axis=1)[label]
-    if denom == 0:
-        denom = 1
-    precision = trueP / denom
-    return precision, recall
+    '''
+    Returns the precision and recall of class `label`. cmatrix can also be a
+    stack of confusion matrices [..., numClasses, numClasses], in which case
+    arrays of shape [...] are returned.
+    '''
+    cmatrix = np.asarray(cmatrix)
+    trueP = cmatrix[..., label, label]
+    recall = _divideOrZero(trueP, np.sum(cmatrix, axis=-2)[..., label])
+    precision = _divideOrZero(trueP, np.sum(cmatrix, axis=-1)[..., label])
+    return precision[()], recall[()]
 
 
 def getMacroPrecisionRecall(cmatrix):
+    cmatrix = np.asarray(cmatrix)
+    diag = np.diagonal(cmatrix, axis1=-2, axis2=-1)
     # TP + FP
-    precisionlist = np.sum(cmatrix, axis=1)
+    precisionlist = _divideOrZero(diag, np.sum(cmatrix, axis=-1))
     # TP + FN
-    recalllist = np.sum(cmatrix, axis=0)
-    precisionlist__ = [cmatrix[i][i] / x if x !=
-                       0 else 0 for i, x in enumerate(precisionlist)]
-    recalllist__ = [cmatrix[i][i] / x if x !=
-                    0 else 0 for i, x in enumerate(recalllist)]
-    precision = np.sum(precisionlist__)
-    precision /= len(precisionlist__)
-    recall = np.sum(recalllist__)
-    recall /= len(recalllist__)
-    return precision, recall
+    recalllist = _divideOrZero(diag, np.sum(cmatrix, axis=-2))
+    precision = np.mean(precisionlist, axis=-1)
+    recall = np.mean(recalllist, axis=-1)
+    return precision[()], recall[()]
 
 
 def getMicroPrecisionRecall(cmatrix):
-    # TP + FP
-    precisionlist = np.sum(cmatrix, axis=1)
-    # TP + FN
-    recalllist = np.sum(cmatrix, axis=0)
-    num = 0.0
-    for i in range(len(cmatrix)):
-        num += cmatrix[i][i]
-
-    precision = num / np.sum(precisionlist)
-    recall = num / np.sum(recalllist)
-    return precision, recall
+    cmatrix = np.asarray(cmatrix)
+    num = np.trace(cmatrix, axis1=-2, axis2=-1)
+    # TP + FP and TP + FN summed over all classes are both the total count
+    total = np.sum(cmatrix, axis=(-2, -1))
+    precision = _divideOrZero(num, total)
+    recall = _divideOrZero(num, total)
+    return precision[()], recall[()]
 
 
 def getMacroMicroFScore(cmatrix):
     '''
     Returns macro and micro f-scores.
     Refer: http://citeseerx.ist.psu.edu/viewdoc/download?doi=10.1.1.104.8244&rep=rep1&type=pdf
+
+    Like the other metrics, cmatrix can be a single confusion matrix or a
+    stack [..., numClasses, numClasses] of them.
     '''
-    precisionlist = np.sum(cmatrix, axis=1)
-    recalllist = np.sum(cmatrix, axis=0)
-    precisionlist__ = [cmatrix[i][i] / x if x !=
-                       0 else 0 for i, x in enumerate(precisionlist)]
-    recalllist__ = [cmatrix[i][i] / x if x !=
-                    0 else 0 for i, x in enumerate(recalllist)]
-    macro = 0.0
-    for i in range(len(precisionlist)):
-        denom = precisionlist__[i] + recalllist__[i]
-        numer = precisionlist__[i] * recalllist__[i] * 2
-        if denom == 0:
-            denom = 1
-        macro += numer / denom
-    macro /= len(precisionlist)
-
-    num = 0.0
-    for i in range(len(precisionlist)):
-        num += cmatrix[i][i]
-
-    denom1 = np.sum(precisionlist)
-    denom2 = np.sum(recalllist)
-    pi = num / denom1
-    rho = num / denom2
-    denom = pi + rho
-    if denom == 0:
-        denom = 1
-    micro = 2 * pi * rho / denom
-    return macro, micro
+    cmatrix = np.asarray(cmatrix)
+    diag = np.diagonal(cmatrix, axis1=-2, axis2=-1)
+    precisionlist = _divideOrZero(diag, np.sum(cmatrix, axis=-1))
+    recalllist = _divideOrZero(diag, np.sum(cmatrix, axis=-2))
+    fscorelist = _divideOrZero(2 * precisionlist * recalllist,
+                               precisionlist + recalllist)
+    macro = np.mean(fscorelist, axis=-1)
+
+    pi, rho = getMicroPrecisionRecall(cmatrix)
+    micro = _divideOrZero(2 * pi * rho, pi + rho)
+    return macro[()], micro[()]
+
+
+class BatchFeeder:
+    '''
+    Generates numEpochs * numBatches mini-batches (X[batch], Y[batch]) of
+    batchSize rows. The batches are sliced (and transformed) on a background
+    thread which keeps up to `prefetch` batches ready, so that this host side
+    work overlaps with the session running the previous step.
+
+    X, Y: Arrays (numpy arrays, memmaps or scipy.sparse matrices) indexed
+        along the first axis.
+    numBatches: Batches per epoch. Defaults to ceil(len / batchSize).
+    shuffle: If True, the rows are visited in a new random order every
+        epoch. Otherwise, batch j of every epoch is rows
+        [j * batchSize, (j + 1) * batchSize).
+    transform: Optional callable transform(batchX, batchY) that returns the
+        values to be fed (for instance, reshaped or sparse tensor values).
+    prefetch: Number of batches prepared ahead of time. Set to 0 to generate
+        batches synchronously in getBatch().
+    seed: Seed for the shuffling.
+    '''
+
+    __END = 'end'
+    __ERROR = 'error'
+
+    def __init__(self, X, Y, batchSize, numEpochs, numBatches=None,
+                 shuffle=False, transform=None, prefetch=2, seed=None):
+        assert X.shape[0] == Y.shape[0], 'X and Y should have same length'
+        self.X = X
+        self.Y = Y
+        self.batchSize = batchSize
+        self.numEpochs = numEpochs
+        if numBatches is None:
+            numBatches = int(np.ceil(X.shape[0] / float(batchSize)))
+        self.numBatches = numBatches
+        self.shuffle = shuffle
+        self.transform = transform
+        self.prefetch = prefetch
+        self.seed = seed
+        self.__generator = self.__generateBatches()
+        self.__thread = None
+        # Set once the last batch (or an error) has been returned, or the
+        # feeder was closed. Later getBatch calls raise StopIteration.
+        self.__done = False
+        if prefetch > 0:
+            self.__queue = queue.Queue(maxsize=prefetch)
+            self.__stopEvent = threading.Event()
+            self.__thread = threading.Thread(target=self.__worker)
+            self.__thread.daemon = True
+            self.__thread.start()
+
+    def __generateBatches(self):
+        randomState = np.random.RandomState(self.seed)
+        numRows = self.X.shape[0]
+        for epoch in range(self.numEpochs):
+            if self.shuffle:
+                order = randomState.permutation(numRows)
+            for j in range(self.numBatches):
+                start = j * self.batchSize
+                end = min((j + 1) * self.batchSize, numRows)
+                if self.shuffle:
+                    index = order[start:end]
+                else:
+                    index = slice(start, end)
+                batchX, batchY = self.X[index], self.Y[index]
+                if self.transform is not None:
+                    yield self.transform(batchX, batchY)
+                else:
+                    yield batchX, batchY
+
+    def __put(self, item):
+        while not self.__stopEvent.is_set():
+            try:
+                self.__queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __worker(self):
+        try:
+            for batch in self.__generator:
+                if not self.__put((None, batch)):
+                    return
+            self.__put((self.__END, None))
+        except Exception as e:
+            self.__put((self.__ERROR, e))
+
+    def getBatch(self):
+        '''
+        Returns the next (batchX, batchY), or the output of transform for it.
+        Raises StopIteration once all the batches have been returned (and on
+        every later call).
+        '''
+        if self.__done:
+            raise StopIteration()
+        if self.__thread is None:
+            try:
+                return next(self.__generator)
+            except Exception:
+                self.__done = True
+                raise
+        status, value = self.__queue.get()
+        if status == self.__END:
+            self.__done = True
+            raise StopIteration()
+        if status == self.__ERROR:
+            self.__done = True
+            raise value
+        return value
+
+    def close(self):
+        '''
+        Stops the background thread. Should be called if not all batches
+        are consumed.
+        '''
+        self.__done = True
+        if self.__thread is None:
+            return
+        self.__stopEvent.set()
+        self.__thread.join()
+        self.__thread = None
 
 
 class GraphManager:
@@ -314,3 +658,14 @@ class GraphManager:
         saver.restore(sess, metaname)
         graph = tf.get_default_graph()
         return graph
+
+    def restoreVariables(self, saver, sess, modelPrefix, globalStep,
+                         redirFile=None):
+        '''
+        Restores only the variable values of the checkpoint at
+        modelPrefix-globalStep into the graph of sess. Unlike loadCheckpoint
+        the meta graph is not imported, the graph and session are reused.
+        '''
+        checkpoint = modelPrefix + '-%d' % globalStep
+        saver.restore(sess, checkpoint)
+        print('Variables restored from %s' % checkpoint, file=redirFile)
@@ -37,7 +37,8 @@ def main():
     outFile = args.output_file
 
     (dataDimension, numClasses,
-        Xtrain, Ytrain, Xtest, Ytest) = helpermethods.preProcessData(dataDir)
+        Xtrain, Ytrain, Xtest, Ytest) = helpermethods.preProcessData(
+            dataDir, mmap=args.mmap)
 
     sparZ = args.sZ
 
@@ -76,7 +77,8 @@ def main():
 
     # numClasses = 1 for binary case
     bonsaiObj = Bonsai(numClasses, dataDimension,
-                       projectionDimension, depth, sigma)
+                       projectionDimension, depth, sigma,
+                       fusedNodeEval=args.fused_node_eval)
 
     bonsaiTrainer = BonsaiTrainer(bonsaiObj,
                                   regW, regT, regV, regZ,
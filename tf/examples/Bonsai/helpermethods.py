@@ -102,6 +102,14 @@ def getArgs():
     parser.add_argument('-oF', '--output-file', default=None,
                         help='Output file for dumping the program output, ' +
                         '(default: stdout)')
+    parser.add_argument('--mmap', action='store_true',
+                        help='Memory map train.npy and test.npy and ' +
+                        'normalise the data lazily (for data larger ' +
+                        'than memory)')
+    parser.add_argument('--fused-node-eval', action='store_true',
+                        help='Evaluate all the tree nodes with one matmul ' +
+                        'each for W, V and T instead of per node ops ' +
+                        '(faster for deeper trees)')
 
     return parser.parse_args()
 
@@ -129,35 +137,50 @@ def createTimeStampDir(dataDir):
     return None
 
 
-def preProcessData(dataDir):
+def preProcessData(dataDir, mmap=False):
     '''
     Function to pre-process input data
     Expects a .npy file of form [lbl feats] for each datapoint
     Outputs a train and test set datapoints appended with 1 for Bias induction
     dataDimension, numClasses are inferred directly
+
+    mmap: If True, Xtrain and Xtest are edgeml.datasets.NpyDataset objects
+    that memory map the files and return normalised, bias appended float32
+    rows when indexed, instead of in-memory arrays
     '''
-    train = np.load(dataDir + '/train.npy')
-    test = np.load(dataDir + '/test.npy')
+    if mmap:
+        # Imported here as edgeml is added to the path by the example script
+        from edgeml.datasets import NpyDataset
+        Xtrain = NpyDataset(dataDir + '/train.npy', addBias=True)
+        Xtest = NpyDataset(dataDir + '/test.npy', mean=Xtrain.mean,
+                           std=Xtrain.std, addBias=True)
+        dataDimension = Xtrain.dataDimension
+        Ytrain_ = Xtrain.getLabels()
+        Ytest_ = Xtest.getLabels()
+    else:
+        train = np.load(dataDir + '/train.npy')
+        test = np.load(dataDir + '/test.npy')
 
-    dataDimension = int(train.shape[1]) - 1
+        dataDimension = int(train.shape[1]) - 1
 
-    Xtrain = train[:, 1:dataDimension + 1]
-    Ytrain_ = train[:, 0]
-    numClasses = max(Ytrain_) - min(Ytrain_) + 1
+        Xtrain = train[:, 1:dataDimension + 1]
+        Ytrain_ = train[:, 0]
 
-    Xtest = test[:, 1:dataDimension + 1]
-    Ytest_ = test[:, 0]
+        Xtest = test[:, 1:dataDimension + 1]
+        Ytest_ = test[:, 0]
 
+    numClasses = max(Ytrain_) - min(Ytrain_) + 1
     numClasses = int(max(numClasses, max(Ytest_) - min(Ytest_) + 1))
 
-    # Mean Var Normalisation
-    mean = np.mean(Xtrain, 0)
-    std = np.std(Xtrain, 0)
-    std[std[:] < 0.000001] = 1
-    Xtrain = (Xtrain - mean) / std
+    if not mmap:
+        # Mean Var Normalisation
+        mean = np.mean(Xtrain, 0)
+        std = np.std(Xtrain, 0)
+        std[std[:] < 0.000001] = 1
+        Xtrain = (Xtrain - mean) / std
 
-    Xtest = (Xtest - mean) / std
-    # End Mean Var normalisation
+        Xtest = (Xtest - mean) / std
+        # End Mean Var normalisation
 
     lab = Ytrain_.astype('uint8')
     lab = np.array(lab) - min(lab)
@@ -179,10 +202,11 @@ def preProcessData(dataDir):
     else:
         Ytest = lab_
 
-    trainBias = np.ones([Xtrain.shape[0], 1])
-    Xtrain = np.append(Xtrain, trainBias, axis=1)
-    testBias = np.ones([Xtest.shape[0], 1])
-    Xtest = np.append(Xtest, testBias, axis=1)
+    if not mmap:
+        trainBias = np.ones([Xtrain.shape[0], 1])
+        Xtrain = np.append(Xtrain, trainBias, axis=1)
+        testBias = np.ones([Xtest.shape[0], 1])
+        Xtest = np.append(Xtest, testBias, axis=1)
 
     return dataDimension + 1, numClasses, Xtrain, Ytrain, Xtest, Ytest
 
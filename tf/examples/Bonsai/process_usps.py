@@ -7,18 +7,19 @@
 import subprocess
 import os
 import numpy as np
-from sklearn.datasets import load_svmlight_file
 import sys
 
-def processData(workingDir, downloadDir):
-    def loadLibSVMFile(file):
-        data = load_svmlight_file(file)
-        features = data[0]
-        labels = data[1]
-        retMat = np.zeros([features.shape[0], features.shape[1] + 1])
-        retMat[:, 0] = labels
-        retMat[:, 1:] = features.todense()
-        return retMat
+sys.path.insert(0, '../../')
+
+
+def processData(workingDir, downloadDir, numProcesses=1):
+    '''
+    Converts train.txt and test.txt (svmlight format) into train.npy and
+    test.npy of form [lbl feats]. The files are converted chunk by chunk
+    straight into float32 .npy files (see edgeml.datasets.convertSvmlight),
+    so the complete dense matrices are never held in memory.
+    '''
+    from edgeml.datasets import convertSvmlight
 
     path = workingDir + '/' + downloadDir
     path = os.path.abspath(path)
@@ -26,10 +27,12 @@ def processData(workingDir, downloadDir):
     tsf = path + '/test.txt'
     assert os.path.isfile(trf), 'File not found: %s' % trf
     assert os.path.isfile(tsf), 'File not found: %s' % tsf
-    train = loadLibSVMFile(trf)
-    test = loadLibSVMFile(tsf)
-    np.save(path + '/train.npy', train)
-    np.save(path + '/test.npy', test)
+    train = convertSvmlight(trf, path + '/train.npy',
+                            numProcesses=numProcesses)
+    # Test features use the dimension of the training set
+    numFeatures = np.load(train, mmap_mode='r').shape[1] - 1
+    convertSvmlight(tsf, path + '/test.npy', numFeatures=numFeatures,
+                    numProcesses=numProcesses)
 
 if __name__ == '__main__':
     # Configuration
@@ -215,65 +215,93 @@ def loadData(dirname):
     return x_train, y_train, x_test, y_test, x_val, y_val
 
 
-def bagData(X, Y, subinstanceLen, subinstanceStride):
+def bagData(X, Y, subinstanceLen, subinstanceStride, xFile=None,
+            yFile=None):
     '''
     Takes x and y of shape
-    [-1, 128, 9] and [-1, 6] respectively and converts it into bags of instances.
-    returns [-1, numInstance, ]
+    [-1, numSteps, numFeats] and [-1, numClass] respectively and converts it
+    into bags of instances.
+    returns [-1, numSubinstance, subinstanceLen, numFeats] and
+    [-1, numSubinstance, numClass]
+
+    Subinstances start every subinstanceStride steps until one reaches the
+    end of the time series; only this last subinstance is zero padded. The
+    full subinstances are copied out of a strided view of X, without building
+    per window copies.
+
+    xFile, yFile: If provided, the bags are written directly to these .npy
+        files (memory mapped) and the memory maps are returned. X itself can
+        be a memory mapped array (np.load(..., mmap_mode='r')).
     '''
-    numClass = 6
-    numSteps = 128
-    numFeats = 9
     assert X.ndim == 3
-    assert X.shape[1] == numSteps
-    assert X.shape[2] == numFeats
+    numSteps = X.shape[1]
+    numFeats = X.shape[2]
     assert subinstanceLen <= numSteps
     assert subinstanceLen > 0
     assert subinstanceStride <= numSteps
     assert subinstanceStride >= 0
     assert len(X) == len(Y)
     assert Y.ndim == 2
-    assert Y.shape[1] == numClass
-    x_bagged = []
-    y_bagged = []
-    for i, point in enumerate(X[:, :, :]):
-        instanceList = []
-        start = 0
-        end = subinstanceLen
-        while True:
-            x = point[start:end, :]
-            if len(x) < subinstanceLen:
-                x_ = np.zeros([subinstanceLen, x.shape[1]])
-                x_[:len(x), :] = x[:, :]
-                x = x_
-            instanceList.append(x)
-            if end >= numSteps:
-                break
-            start += subinstanceStride
-            end += subinstanceStride
-        bag = np.array(instanceList)
-        numSubinstance = bag.shape[0]
-        label = Y[i]
-        label = np.argmax(label)
-        labelBag = np.zeros([numSubinstance, numClass])
-        labelBag[:, label] = 1
-        x_bagged.append(bag)
-        label = np.array(labelBag)
-        y_bagged.append(label)
-    return np.array(x_bagged), np.array(y_bagged)
+    numClass = Y.shape[1]
+    if subinstanceLen == numSteps:
+        numSubinstance = 1
+    else:
+        assert subinstanceStride > 0
+        numSubinstance = -(-(numSteps - subinstanceLen) // subinstanceStride)
+        numSubinstance += 1
+    # Subinstances that fit entirely in the time series
+    numFull = (numSteps - subinstanceLen) // max(subinstanceStride, 1) + 1
+    numFull = min(numFull, numSubinstance)
+
+    xShape = (len(X), numSubinstance, subinstanceLen, numFeats)
+    yShape = (len(X), numSubinstance, numClass)
+    if xFile is not None:
+        x_bagged = np.lib.format.open_memmap(xFile, mode='w+',
+                                             dtype=X.dtype, shape=xShape)
+    else:
+        x_bagged = np.empty(xShape, dtype=X.dtype)
+    if yFile is not None:
+        y_bagged = np.lib.format.open_memmap(yFile, mode='w+',
+                                             dtype=Y.dtype, shape=yShape)
+    else:
+        y_bagged = np.empty(yShape, dtype=Y.dtype)
+
+    # Process a block of points at a time to bound the memory of the copies
+    # when X is memory mapped
+    blockSize = 4096
+    for start in range(0, len(X), blockSize):
+        x = np.asarray(X[start:start + blockSize])
+        windows = np.lib.stride_tricks.as_strided(
+            x, shape=(len(x), numFull, subinstanceLen, numFeats),
+            strides=(x.strides[0], subinstanceStride * x.strides[1],
+                     x.strides[1], x.strides[2]), writeable=False)
+        x_bagged[start:start + len(x), :numFull] = windows
+        if numFull < numSubinstance:
+            lastStart = (numSubinstance - 1) * subinstanceStride
+            lastLen = numSteps - lastStart
+            x_bagged[start:start + len(x), -1, :lastLen] = x[:, lastStart:]
+            x_bagged[start:start + len(x), -1, lastLen:] = 0
+        label = np.argmax(Y[start:start + len(x)], axis=1)
+        y = np.zeros([len(x), numSubinstance, numClass], dtype=Y.dtype)
+        y[np.arange(len(x)), :, label] = 1
+        y_bagged[start:start + len(x)] = y
+    if xFile is not None:
+        x_bagged.flush()
+    if yFile is not None:
+        y_bagged.flush()
+    return x_bagged, y_bagged
 
 
 def makeEMIData(subinstanceLen, subinstanceStride, sourceDir, outDir):
-    x_train, y_train, x_test, y_test, x_val, y_val = loadData(sourceDir)
-    x, y = bagData(x_train, y_train, subinstanceLen, subinstanceStride)
-    np.save(outDir + '/x_train.npy', x)
-    np.save(outDir + '/y_train.npy', y)
-    print('Num train %d' % len(x))
-    x, y = bagData(x_test, y_test, subinstanceLen, subinstanceStride)
-    np.save(outDir + '/x_test.npy', x)
-    np.save(outDir + '/y_test.npy', y)
-    print('Num test %d' % len(x))
-    x, y = bagData(x_val, y_val, subinstanceLen, subinstanceStride)
-    np.save(outDir + '/x_val.npy', x)
-    np.save(outDir + '/y_val.npy', y)
-    print('Num val %d' % len(x))
+    '''
+    Bags the splits in sourceDir and writes them to outDir. The raw splits
+    are memory mapped and the bags are written directly to the output files.
+    '''
+    for split in ['train', 'test', 'val']:
+        x = np.load(sourceDir + '/x_%s.npy' % split, mmap_mode='r')
+        y = np.load(sourceDir + '/y_%s.npy' % split, mmap_mode='r')
+        x, y = bagData(x, y, subinstanceLen, subinstanceStride,
+                       xFile=outDir + '/x_%s.npy' % split,
+                       yFile=outDir + '/y_%s.npy' % split)
+        print('Num %s %d' % (split, len(x)))
+        del x, y
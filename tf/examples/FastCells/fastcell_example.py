@@ -42,7 +42,8 @@ def main():
     gate_non_linearity = args.gate_nl
 
     (dataDimension, numClasses,
-        Xtrain, Ytrain, Xtest, Ytest) = helpermethods.preProcessData(dataDir)
+        Xtrain, Ytrain, Xtest, Ytest) = helpermethods.preProcessData(
+            dataDir, mmap=args.mmap)
 
     assert dataDimension % inputDims == 0, "Infeasible per step input, " + \
         "Timesteps have to be integer"
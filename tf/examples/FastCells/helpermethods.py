@@ -110,6 +110,10 @@ def getArgs():
     parser.add_argument('-oF', '--output-file', default=None,
                         help='Output file for dumping the program output, ' +
                         '(default: stdout)')
+    parser.add_argument('--mmap', action='store_true',
+                        help='Memory map train.npy and test.npy and ' +
+                        'normalise the data lazily (for data larger ' +
+                        'than memory)')
 
     return parser.parse_args()
 
@@ -161,7 +165,7 @@ def createTimeStampDir(dataDir, cell):
     return None
 
 
-def preProcessData(dataDir):
+def preProcessData(dataDir, mmap=False):
     '''
     Function to pre-process input data
 
@@ -171,29 +175,44 @@ def preProcessData(dataDir):
 
     Outputs train and test set datapoints
     dataDimension, numClasses are inferred directly
-    '''
-    train = np.load(dataDir + '/train.npy')
-    test = np.load(dataDir + '/test.npy')
 
-    dataDimension = int(train.shape[1]) - 1
+    mmap: If True, Xtrain and Xtest are edgeml.datasets.NpyDataset objects
+    that memory map the files and return normalised float32 rows when
+    indexed, instead of in-memory arrays
+    '''
+    if mmap:
+        # Imported here as edgeml is added to the path by the example script
+        from edgeml.datasets import NpyDataset
+        Xtrain = NpyDataset(dataDir + '/train.npy')
+        Xtest = NpyDataset(dataDir + '/test.npy', mean=Xtrain.mean,
+                           std=Xtrain.std)
+        dataDimension = Xtrain.dataDimension
+        Ytrain_ = Xtrain.getLabels()
+        Ytest_ = Xtest.getLabels()
+    else:
+        train = np.load(dataDir + '/train.npy')
+        test = np.load(dataDir + '/test.npy')
+
+        dataDimension = int(train.shape[1]) - 1
+
+        Xtrain = train[:, 1:dataDimension + 1]
+        Ytrain_ = train[:, 0]
+
+        Xtest = test[:, 1:dataDimension + 1]
+        Ytest_ = test[:, 0]
 
-    Xtrain = train[:, 1:dataDimension + 1]
-    Ytrain_ = train[:, 0]
     numClasses = max(Ytrain_) - min(Ytrain_) + 1
-
-    Xtest = test[:, 1:dataDimension + 1]
-    Ytest_ = test[:, 0]
-
     numClasses = int(max(numClasses, max(Ytest_) - min(Ytest_) + 1))
 
-    # Mean Var Normalisation
-    mean = np.mean(Xtrain, 0)
-    std = np.std(Xtrain, 0)
-    std[std[:] < 0.000001] = 1
-    Xtrain = (Xtrain - mean) / std
+    if not mmap:
+        # Mean Var Normalisation
+        mean = np.mean(Xtrain, 0)
+        std = np.std(Xtrain, 0)
+        std[std[:] < 0.000001] = 1
+        Xtrain = (Xtrain - mean) / std
 
-    Xtest = (Xtest - mean) / std
-    # End Mean Var normalisation
+        Xtest = (Xtest - mean) / std
+        # End Mean Var normalisation
 
     lab = Ytrain_.astype('uint8')
     lab = np.array(lab) - min(lab)
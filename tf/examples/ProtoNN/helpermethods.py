@@ -48,9 +48,19 @@ def getModelSize(matrixList, sparcityList, expected=True, bytesPerVar=4):
     return numNonZero, totalSize, hasSparse
 
 
-def getGamma(gammaInit, projectionDim, dataDim, numPrototypes, x_train):
+def getGamma(gammaInit, projectionDim, dataDim, numPrototypes, x_train,
+             numSamples=None):
+    '''
+    numSamples: If provided, the median heuristic is computed on a random
+    sub-sample of numSamples rows of x_train (for instance when x_train is a
+    memory mapped data set that should not be loaded as a whole).
+    '''
     if gammaInit is None:
         print("Using median heuristic to estimate gamma.")
+        if numSamples is not None and numSamples < x_train.shape[0]:
+            index = np.random.choice(x_train.shape[0], numSamples,
+                                     replace=False)
+            x_train = x_train[np.sort(index)]
         gamma, W, B = utils.medianHeuristic(x_train, projectionDim,
                                             numPrototypes)
         print("Gamma estimate is: %f" % gamma)
@@ -58,7 +68,7 @@ def getGamma(gammaInit, projectionDim, dataDim, numPrototypes, x_train):
     return None, None, gammaInit
 
 
-def preprocessData(dataDir):
+def preprocessData(dataDir, mmap=False):
     '''
     Loads data from the dataDir and does some initial preprocessing
     steps. Data is assumed to be contained in two files,
@@ -68,26 +78,41 @@ def preprocessData(dataDir):
 
     For an N-Class problem, we assume the labels are integers from 0 through
     N-1.
-    '''
-    train = np.load(dataDir + '/train.npy')
-    test = np.load(dataDir + '/test.npy')
 
-    dataDimension = int(train.shape[1]) - 1
-    x_train = train[:, 1:dataDimension + 1]
-    y_train_ = train[:, 0]
-    x_test = test[:, 1:dataDimension + 1]
-    y_test_ = test[:, 0]
+    mmap: If True, x_train and x_test are edgeml.datasets.NpyDataset objects
+    that memory map the files and return normalised float32 rows when
+    indexed, instead of in-memory arrays.
+    '''
+    if mmap:
+        # Imported here as edgeml is added to the path by the example script
+        from edgeml.datasets import NpyDataset
+        x_train = NpyDataset(dataDir + '/train.npy')
+        x_test = NpyDataset(dataDir + '/test.npy', mean=x_train.mean,
+                            std=x_train.std)
+        dataDimension = x_train.dataDimension
+        y_train_ = x_train.getLabels()
+        y_test_ = x_test.getLabels()
+    else:
+        train = np.load(dataDir + '/train.npy')
+        test = np.load(dataDir + '/test.npy')
+
+        dataDimension = int(train.shape[1]) - 1
+        x_train = train[:, 1:dataDimension + 1]
+        y_train_ = train[:, 0]
+        x_test = test[:, 1:dataDimension + 1]
+        y_test_ = test[:, 0]
 
     numClasses = max(y_train_) - min(y_train_) + 1
     numClasses = max(numClasses, max(y_test_) - min(y_test_) + 1)
     numClasses = int(numClasses)
 
-    # mean-var
-    mean = np.mean(x_train, 0)
-    std = np.std(x_train, 0)
-    std[std[:] < 0.000001] = 1
-    x_train = (x_train - mean) / std
-    x_test = (x_test - mean) / std
+    if not mmap:
+        # mean-var
+        mean = np.mean(x_train, 0)
+        std = np.std(x_train, 0)
+        std[std[:] < 0.000001] = 1
+        x_train = (x_train - mean) / std
+        x_test = (x_test - mean) / std
 
     # one hot y-train
     lab = y_train_.astype('uint8')
@@ -192,4 +217,12 @@ def getProtoNNArgs():
     parser.add_argument('-vS', '--val-step', type=int, default=3,
                         help='The number of epochs between validation' +
                         'performance evaluation')
+    parser.add_argument('--mmap', action='store_true',
+                        help='Memory map train.npy and test.npy and ' +
+                        'normalise the data lazily (for data larger ' +
+                        'than memory)')
+    parser.add_argument('--norm-expansion', action='store_true',
+                        help='Compute the prototype distances with ' +
+                        '||WX||^2 - 2WX.B + ||B||^2 (lower memory for ' +
+                        'many prototypes)')
     return parser.parse_args()
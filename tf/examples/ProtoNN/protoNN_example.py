@@ -32,14 +32,19 @@ def main():
     VAL_STEP = config.val_step
 
     # Load data
-    out = helper.preprocessData(DATA_DIR)
+    out = helper.preprocessData(DATA_DIR, mmap=config.mmap)
     dataDimension = out[0]
     numClasses = out[1]
     x_train, y_train = out[2], out[3]
     x_test, y_test = out[4], out[5]
 
+    # With --mmap, gamma is estimated on a sub-sample of the training set
+    numSamples = None
+    if config.mmap:
+        numSamples = 10000
     W, B, gamma = helper.getGamma(config.gamma, PROJECTION_DIM, dataDimension,
-                                  NUM_PROTOTYPES, x_train)
+                                  NUM_PROTOTYPES, x_train,
+                                  numSamples=numSamples)
 
     # Setup input and train protoNN
     X = tf.placeholder(tf.float32, [None, dataDimension], name='X')
@@ -49,13 +54,23 @@ def main():
                       gamma, W=W, B=B)
     trainer = ProtoNNTrainer(protoNN, REG_W, REG_B, REG_Z,
                              SPAR_W, SPAR_B, SPAR_Z,
-                             LEARNING_RATE, X, Y, lossType='xentropy')
+                             LEARNING_RATE, X, Y, lossType='xentropy',
+                             normExpansion=config.norm_expansion)
     sess = tf.Session()
     trainer.train(BATCH_SIZE, NUM_EPOCHS, sess, x_train, x_test,
                   y_train, y_test, printStep=PRINT_STEP, valStep=VAL_STEP)
 
     # Print some summary metrics
-    acc = sess.run(protoNN.accuracy, feed_dict={X: x_test, Y: y_test})
+    # Evaluated in chunks so that a memory mapped test set is never loaded
+    # as a whole
+    acc = 0.0
+    for start in range(0, x_test.shape[0], BATCH_SIZE):
+        batchX = x_test[start:start + BATCH_SIZE]
+        batchY = y_test[start:start + BATCH_SIZE]
+        batchAcc = sess.run(protoNN.accuracy, feed_dict={X: batchX,
+                                                         Y: batchY})
+        acc += batchAcc * batchY.shape[0]
+    acc /= x_test.shape[0]
     # W, B, Z are tensorflow graph nodes
     W, B, Z, _ = protoNN.getModelMatrices()
     matrixList = sess.run([W, B, Z])
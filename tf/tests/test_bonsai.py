@@ -0,0 +1,45 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+
+import os
+import sys
+import numpy as np
+import pytest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+tf = pytest.importorskip('tensorflow')
+from edgeml.graph.bonsai import Bonsai
+
+
+def getScore(fusedNodeEval, X, params, numClasses, treeDepth, sigma,
+             sigmaI):
+    W, T, V, Z = params
+    graph = tf.Graph()
+    with graph.as_default():
+        bonsaiObj = Bonsai(numClasses, Z.shape[1], Z.shape[0], treeDepth,
+                           sigma, W=W, T=T, V=V, Z=Z,
+                           fusedNodeEval=fusedNodeEval)
+        Xph = tf.placeholder(tf.float32, [None, Z.shape[1]])
+        score, _ = bonsaiObj(Xph, sigmaI)
+        with tf.Session(graph=graph) as sess:
+            sess.run(tf.global_variables_initializer())
+            return sess.run(score, feed_dict={Xph: X})
+
+
+@pytest.mark.parametrize('numClasses,treeDepth,sigmaI', [
+    (2, 0, 1.0), (2, 2, 1.0), (4, 3, 1.0), (4, 3, 1e9)])
+def test_fusedNodeEvalMatchesPerNode(numClasses, treeDepth, sigmaI):
+    rng = np.random.RandomState(0)
+    dataDimension, projectionDimension = 10, 4
+    internalNodes = 2**treeDepth - 1
+    totalNodes = 2 * internalNodes + 1
+    rows = (1 if numClasses == 2 else numClasses) * totalNodes
+    W = rng.randn(rows, projectionDimension).astype(np.float32)
+    V = rng.randn(rows, projectionDimension).astype(np.float32)
+    T = rng.randn(internalNodes, projectionDimension).astype(np.float32)
+    Z = rng.randn(projectionDimension, dataDimension).astype(np.float32)
+    X = rng.randn(30, dataDimension).astype(np.float32)
+    params = (W, T, V, Z)
+    perNode = getScore(False, X, params, numClasses, treeDepth, 1.5, sigmaI)
+    fused = getScore(True, X, params, numClasses, treeDepth, 1.5, sigmaI)
+    assert fused.shape == perNode.shape
+    assert np.allclose(fused, perNode, rtol=1e-5, atol=1e-5)
@@ -0,0 +1,77 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT license.
+
+import os
+import sys
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from edgeml.predictor.bonsaiPredictor import BonsaiPredictor
+
+
+def graphScore(X, W, T, V, Z, numClasses, treeDepth, sigma, sigmaI=1e9):
+    '''
+    Numpy copy of the score of edgeml.graph.bonsai.Bonsai (per node path)
+    '''
+    projectionDimension = Z.shape[0]
+    internalNodes = 2**treeDepth - 1
+    totalNodes = 2 * internalNodes + 1
+    X_ = np.dot(Z, X.T) / projectionDimension
+    nodeProb = [1.0]
+    W_, V_ = W[0:numClasses], V[0:numClasses]
+    score = np.dot(W_, X_) * np.tanh(sigma * np.dot(V_, X_))
+    for i in range(1, totalNodes):
+        W_ = W[i * numClasses:(i + 1) * numClasses]
+        V_ = V[i * numClasses:(i + 1) * numClasses]
+        parent = int(np.ceil(i / 2.0) - 1.0)
+        T_ = T[parent].reshape([1, -1])
+        prob = (1 + ((-1)**(i + 1)) * np.tanh(sigmaI * np.dot(T_, X_))) / 2.0
+        prob = nodeProb[parent] * prob
+        nodeProb.append(prob)
+        score = score + prob * np.dot(W_, X_) * np.tanh(sigma * np.dot(V_, X_))
+    return score
+
+
+def getModel(numClasses, dataDimension, projectionDimension, treeDepth,
+             seed=0):
+    rng = np.random.RandomState(seed)
+    internalNodes = 2**treeDepth - 1
+    totalNodes = 2 * internalNodes + 1
+    W = rng.randn(numClasses * totalNodes, projectionDimension)
+    V = rng.randn(numClasses * totalNodes, projectionDimension)
+    T = rng.randn(internalNodes, projectionDimension)
+    Z = rng.randn(projectionDimension, dataDimension)
+    return [A.astype(np.float32) for A in [W, T, V, Z]]
+
+
+def test_scoreMatchesGraphWithTies():
+    numClasses, dataDimension, projectionDimension = 4, 12, 5
+    treeDepth, sigma = 3, 1.5
+    W, T, V, Z = getModel(numClasses, dataDimension, projectionDimension,
+                          treeDepth)
+    # Rows of T zeroed by hard thresholding: every point ties at node 1
+    T[1] = 0
+    rng = np.random.RandomState(1)
+    X = rng.randn(50, dataDimension).astype(np.float32)
+    # Points projecting to 0 tie at every node
+    X[:3] = 0
+    predictor = BonsaiPredictor(numClasses, dataDimension,
+                                projectionDimension, treeDepth, sigma,
+                                W, T, V, Z)
+    expected = graphScore(X.astype(np.float64), W, T, V, Z, numClasses,
+                          treeDepth, sigma)
+    score = predictor(X)
+    assert score.shape == expected.shape
+    assert np.allclose(score, expected, rtol=1e-4, atol=1e-4)
+    assert np.array_equal(predictor.predict(X),
+                          np.argmax(expected, axis=0))
+    assert np.allclose(predictor(X, batchSize=7), score)
+
+
+def test_pathFollowsRightChildOnTies():
+    dataDimension, projectionDimension = 6, 3
+    # Binary case, a single score row per node
+    W, T, V, Z = getModel(1, dataDimension, projectionDimension, 2)
+    predictor = BonsaiPredictor(2, dataDimension, projectionDimension, 2,
+                                1.0, W, T, V, Z)
+    X = np.zeros([2, dataDimension], dtype=np.float32)
+    assert np.array_equal(predictor.getPath(X), [[0, 2, 6], [0, 2, 6]])